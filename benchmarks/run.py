@@ -0,0 +1,215 @@
+"""Benchmarks of the simulation hot paths, compared against a stored baseline.
+
+PV output comes from a deterministic synthetic profile, so this runs offline.
+
+Usage
+-----
+```sh
+python benchmarks/run.py              # compare with benchmarks/baseline.json
+python benchmarks/run.py --save       # record a new baseline
+python benchmarks/run.py -k simulate  # only benchmarks whose name contains "simulate"
+```
+Exits with status 1 if any benchmark is slower than its baseline by more than `--threshold`.
+Baselines are only comparable on the same machine; record one before starting performance work.
+"""
+import argparse
+import json
+import pathlib
+import platform
+import sys
+import timeit
+import numpy as np
+import scipy
+
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1] / "src"))
+import cydrogen  # noqa: E402
+import cydrogen.optimise  # noqa: E402
+
+BASELINE = pathlib.Path(__file__).with_name("baseline.json")
+BENCHMARKS = {}
+
+
+def benchmark(*sizes):
+    """Register a function of the size returning the callable to time, once per size."""
+
+    def register(setup):
+        for n in sizes or (None,):
+            name = setup.__name__ if n is None else f"{setup.__name__}[{n}]"
+            BENCHMARKS[name] = (setup, n)
+        return setup
+
+    return register
+
+
+def stub_profile() -> cydrogen.ArrayProfile:
+    """A clear-sky-like day, scaled by a fixed pseudo-random cloudiness per day."""
+    day = np.clip(np.sin(np.linspace(-np.pi / 2, 3 * np.pi / 2, 24)), 0, None) * 800
+    cloud = np.random.default_rng(0).uniform(0.3, 1, 365)
+    return cydrogen.ArrayProfile(np.repeat(cloud, 24) * np.tile(day, 365))
+
+
+def random_arrays(n: int, degree: int = 3, seed: int = 0) -> dict:
+    """Arrays of a random system of `n` stores with about `degree` edges out of each."""
+    rng = np.random.default_rng(seed)
+    A = np.where(rng.random((n, n)) < degree / n, rng.uniform(0.05, 0.3, (n, n)), 0)
+    np.fill_diagonal(A, 0)
+    return dict(
+        U_0=rng.uniform(0, 1e6, n),
+        U_max=np.full(n, 1e7),
+        U_frac_dt_loss=np.full(n, 1e-4),
+        weighted_A=A,
+        process_power_limits=np.where(A != 0, rng.uniform(10, 200, (n, n)), 0),
+    )
+
+
+def random_system(n: int, steps: int = cydrogen.HOURS_PER_YEAR):
+    g = cydrogen.Graph.from_edges([], [], n=n)
+    return cydrogen.EnergySystem.from_arrays(
+        g, **random_arrays(n), input_nodes=(0,), inputs=np.full((steps, 1), 1e5)
+    )
+
+
+@benchmark(8, 64, 512)
+def dU(n):
+    a = random_arrays(n)
+    return lambda: cydrogen.EnergySystem._dU(
+        a["weighted_A"], a["U_0"], a["process_power_limits"], cydrogen.HOUR
+    )
+
+
+@benchmark(8, 64, 512)
+def update_state(n):
+    s = random_system(n)
+    return lambda: s.update_state(s.U_0)
+
+
+@benchmark(8, 64, 512)
+def simulate(n):
+    s = random_system(n, steps=1000)
+    return lambda: s.simulate(cydrogen.FinalState(), steps=1000)
+
+
+@benchmark()
+def simulate_basic_system():
+    s = cydrogen.basic_system(*[2.5e5] * 4)
+    return lambda: s.simulate()
+
+
+@benchmark()
+def simulate_basic_system_fast_forward():
+    s = cydrogen.basic_system(*[2.5e5] * 4)
+    return lambda: s.simulate(fast_forward=True)
+
+
+@benchmark(12, 30)
+def representative_days(k):
+    s = cydrogen.basic_system(*[2.5e5] * 4)
+    days = cydrogen.RepresentativeDays.from_inputs(s.inputs, k)
+    return lambda: days.simulate(s)
+
+
+@benchmark()
+def basic_system():
+    return lambda: cydrogen.basic_system(*[2.5e5] * 4)
+
+
+@benchmark(8, 64, 512)
+def get_adjacency_matrix(n):
+    g = cydrogen.Graph.from_adjacency_matrix(random_arrays(n)["weighted_A"])
+    # without the compiled snapshot, as after any change to the graph
+    return lambda: (g.invalidate(), g.get_adjacency_matrix())
+
+
+@benchmark(8, 64, 256)
+def Kn(n):
+    return lambda: cydrogen.Graph.Kn(n)
+
+
+@benchmark(64, 512)
+def from_adjacency_matrix(n):
+    A = random_arrays(n)["weighted_A"]
+    return lambda: cydrogen.Graph.from_adjacency_matrix(A)
+
+
+@benchmark()
+def optimiser_iteration():
+    def run():
+        opt = cydrogen.optimise.BudgetAllocator(
+            {
+                "x0": np.ones(3) / 4,
+                "bounds": [(0, 1)] * 3,
+                "method": "L-BFGS-B",
+                "jac": "2-point",
+                "callback": None,
+                "options": {"maxiter": 1},
+            }
+        )
+        opt.total_budget = 1e6
+        return opt()
+
+    return run
+
+
+def measure(fn, repeat: int = 5, min_time: float = 0.2) -> float:
+    """The best time per call (s) over `repeat` rounds of at least `min_time` seconds."""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-k", default="", help="only run benchmarks containing this")
+    parser.add_argument("--save", action="store_true", help="record a new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--baseline", type=pathlib.Path, default=BASELINE)
+    args = parser.parse_args(argv)
+
+    cydrogen.set_default_profile(stub_profile())
+    baseline = (
+        json.loads(args.baseline.read_text())["results"]
+        if args.baseline.exists()
+        else {}
+    )
+    results, regressions = {}, []
+    for name, (setup, n) in BENCHMARKS.items():
+        if args.k not in name:
+            continue
+        t = results[name] = measure(setup() if n is None else setup(n))
+        line = f"{name:<32}{t * 1e3:>12.4f} ms"
+        if name in baseline:
+            change = t / baseline[name] - 1
+            line += f"{change:>+10.1%}"
+            if change > args.threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        args.baseline.write_text(
+            json.dumps(
+                {
+                    "machine": {
+                        "platform": platform.platform(),
+                        "processor": platform.processor(),
+                        "python": platform.python_version(),
+                        "numpy": np.__version__,
+                        "scipy": scipy.__version__,
+                    },
+                    "results": {**baseline, **results},
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+    if regressions:
+        print(
+            f"{len(regressions)} regressions beyond {args.threshold:.0%}: {regressions}"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
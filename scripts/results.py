@@ -1,87 +1,36 @@
+import functools
+import os
 import numpy as np
-from pypvwatts.pypvwatts import PVWatts, PVWattsResult
 import cydrogen
-import cydrogen.optimise
+import cydrogen.sweep
 
-# sample = PVWatts.request(
-#     system_capacity=100,  # Nameplate capacity (kW)
-#     module_type=1,  # Module type: 0: Standard, 1: Premium, 2: Thin film
-#     array_type=1,  # Array type: 0: Fixed - Open Rack, 1: Fixed - Roof Mounted, 2: 1-Axis, 3: 1-Axis Backtracking, 4: 2-Axis
-#     azimuth=190,  # Azimuth angle (degrees)
-#     tilt=30,  # Tilt angle (degrees)
-#     dataset="intl",  # climate dataset to use
-#     losses=14,  # System losses (%)
-#     lat=34.88,  # latitude for the location (north/south) - Larnaca
-#     lon=33.63,  # longitude for the location (west/east)- Larnaca
-#     timeframe="hourly",
-# )
+# shared between runs and workers, so restarts near earlier points reuse their simulations
+cache = cydrogen.EvaluationCache(path="results_cache.sqlite")
 
-
-# def g(s, **kw):
-#     _ = np.array(sample.raw["outputs"]["ac"]) / 100 * kw["system_capacity"]
-
-#     class A:
-#         ...
-
-#     o = A()
-#     o.raw = {"inputs": kw, "outputs": {"ac": _, "ac_annual": _.sum()}}
-#     o.outputs = o.raw["outputs"]
-#     o.inputs = o.raw["inputs"]
-#     return o
-
-
-# cydrogen.model.Sun._request = g
-
-
-def f(num_hevs: int, x0=None):
-    if x0 is None:
-        x0 = [20e3, 20e3, 50e3, 100e3]
-    opt = cydrogen.optimise.MinimiseHEVBudget(
-        {
-            "x0": np.array(x0) * num_hevs,  # np.ones(4) * 7e5,
-            "bounds": [(3500, 3000e6)] + [(0, None)] * 3,  # bounds, PV has limits
-            "options": {"disp": True},
-            "method": "L-BFGS-B",
-            "jac": "2-point",
-        }
-    )
-    opt.output_limit = cydrogen.YEARLY_HYUNDAI_NEXO_ENERGY_CONSUMPTION * num_hevs
-    return opt()
-
-
-for n in [1, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6]:
-    print("#############################################################")
-    print(f"{n = }")
-    print("---------------------------")
-    x0 = None
-    if n == 1:
-        x0 = [7.500e03, 7.500e03, 1.875e04, 3.750e04]
-        continue
-    elif n == 1e1:
-        x0 = [4.8e04, 4.3e04, 4.9e05, 2.345e05]
-        continue
-    elif n == 1e2:
-        x0 = [4.7e05, 4.8e05, 1.3e06, 2.37e06]
-        continue
-    elif n == 1e3:
-        x0 = [3e06, 806, 2e07, 4e07]
-    elif n == 1e4:
-        x0 = [7.500e07, 7.500e07, 1.875e08, 3.750e08]
-    elif n == 1e5:
-        x0 = [7.500e08, 7.500e08, 1.875e09, 3.750e09]
-    elif n == 1e6:
-        x0 = [7.500e09, 7.500e09, 1.875e10, 3.750e10]
-    r = f(n, x0)
-    print("Done optimising!!!")
-    print(r)
-    # print(f"For {n} HEVs, the total budget is {sum(r)} EUR.")
-    print(f"The normalised budget ratio is {np.array(r.x) / sum(r.x)}")
-    d = cydrogen.basic_system(*r.x)
-    d.simulate()
-    print(f"The efficiency of this system is {d.net_efficiency}.")
-    print(
-        f"The total kW of PV nameplate capacity is {d.g.nodes[0].inputs['system_capacity']}."
+if __name__ == "__main__":
+    # finished points are checkpointed in results/, so rerunning resumes the sweep;
+    # each point starts from the nearest finished one, scaled by the number of HEVs
+    results = cydrogen.sweep.run_sweep(
+        [1, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6],
+        "results",
+        functools.partial(
+            cydrogen.sweep.solve_hev, options={"options": {"disp": True}}, cache=cache
+        ),
+        workers=os.cpu_count(),
     )
+    for n, r in sorted(results.items()):
+        print("#############################################################")
+        print(f"{n = }")
+        print("---------------------------")
+        print(r)
+        # print(f"For {n} HEVs, the total budget is {sum(r)} EUR.")
+        print(f"The normalised budget ratio is {np.array(r.x) / sum(r.x)}")
+        d = cydrogen.basic_system(*r.x)
+        d.simulate()
+        print(f"The efficiency of this system is {d.net_efficiency}.")
+        print(
+            f"The total kW of PV nameplate capacity is {d.g.nodes[0].inputs['system_capacity']}."
+        )
 
 # n=1
 #   message: CONVERGENCE: REL_REDUCTION_OF_F_<=_FACTR*EPSMCH
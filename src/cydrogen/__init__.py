@@ -2,6 +2,12 @@
 
 __version__ = "0.1.0"
 
+from .cache import *
+from .telemetry import *
+from .profiles import *
 from .model import *
+from .recording import *
 from .system import *
+from .aggregation import *
+from .results import *
 from .units import *
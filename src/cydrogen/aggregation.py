@@ -0,0 +1,180 @@
+"""Representative days, for screening simulations on a few days instead of a whole year.
+
+Daily PV profiles of one site cluster tightly, so the days of a year are grouped by k-means
+and each group is represented by its most typical (medoid) day. The representative days are
+simulated together as one stack of systems, and stores are carried across the year by
+applying each day's change in the order of the days it represents.
+
+Example
+-------
+```py
+days = RepresentativeDays.from_profile(get_default_profile(), k=12)
+final = days.simulate(system)  # c.f. system.simulate(FinalState())
+print(days.error(system))  # once, against the full year
+```
+"""
+from typing import Optional
+import numpy as np
+import scipy.cluster.vq
+from .profiles import ProfileSource
+from .recording import FinalState
+from .system import EnergySystem
+
+
+class RepresentativeDays:
+    """A clustering of the days of a year into `k` representative days.
+
+    Attributes
+    ----------
+    days
+        The day of the year of each representative day, of shape (k,).
+    weights
+        The number of days each represents, of shape (k,).
+    sequence
+        The representative (0..k-1) of each day of the year, of shape (days,).
+    input_error
+        The total absolute difference between the inputs and their representatives,
+        relative to the total input; see `expand_error_bound`.
+    """
+
+    def __init__(
+        self,
+        days: np.ndarray,
+        sequence: np.ndarray,
+        steps_per_day: int = 24,
+        input_error: float = np.nan,
+    ):
+        self.days = np.asarray(days)
+        self.sequence = np.asarray(sequence)
+        self.weights = np.bincount(self.sequence, minlength=len(self.days))
+        self.steps_per_day = steps_per_day
+        self.input_error = input_error
+
+    @classmethod
+    def from_inputs(
+        cls, inputs: np.ndarray, k: int = 12, steps_per_day: int = 24, seed: int = 0
+    ) -> "RepresentativeDays":
+        """Cluster the days of `inputs`, of shape (steps, ...), by k-means on their profiles."""
+        inputs = np.asarray(inputs, dtype=np.float64)
+        n_days = len(inputs) // steps_per_day
+        X = inputs[: n_days * steps_per_day].reshape(n_days, -1)
+        if k >= n_days:
+            return cls(np.arange(n_days), np.arange(n_days), steps_per_day, 0.0)
+        centroids, labels = scipy.cluster.vq.kmeans2(X, k, minit="++", seed=seed)
+        # the medoid of each non-empty cluster; empty clusters are dropped
+        days = []
+        for c in np.unique(labels):
+            members = np.flatnonzero(labels == c)
+            distance = np.abs(X[members] - centroids[c]).sum(axis=-1)
+            days.append(members[np.argmin(distance)])
+        days = np.array(days)
+        sequence = np.argmin(
+            np.abs(X[:, None, :] - X[days][None, :, :]).sum(axis=-1), axis=-1
+        )
+        total = np.abs(X).sum()
+        input_error = np.abs(X - X[days[sequence]]).sum() / total if total else 0.0
+        return cls(days, sequence, steps_per_day, input_error)
+
+    @classmethod
+    def from_profile(
+        cls, profile: ProfileSource, k: int = 12, seed: int = 0
+    ) -> "RepresentativeDays":
+        """Cluster the days of an hourly PV profile, e.g. that of a `Sun`."""
+        return cls.from_inputs(profile.per_kw(), k, 24, seed)
+
+    def _steps(self, days: np.ndarray) -> np.ndarray:
+        return (
+            days[:, None] * self.steps_per_day + np.arange(self.steps_per_day)
+        ).ravel()
+
+    def expand(self, inputs: np.ndarray) -> np.ndarray:
+        """`inputs` with every day replaced by its representative."""
+        return np.asarray(inputs)[self._steps(self.days[self.sequence])]
+
+    def expand_error_bound(self, system: EnergySystem) -> np.ndarray:
+        """A bound on the total absolute difference between the final states of the full year
+        with its own inputs and with `expand`ed inputs, i.e. of `system.simulate(FinalState())`
+        against `system.simulate(FinalState(), inputs=self.expand(system.inputs))`.
+
+        Returns one bound per scenario of a stacked system.
+
+        This does not bound the error of `simulate`, which also starts each day cyclically and
+        carries stores across days; measure that with `error`.
+        The bound rests on a step never increasing the total difference between two states,
+        which holds if flow fractions and losses are within [0, 1] and no store sends out more
+        than it holds, so that the difference is at most that of the inputs. Inputs may send on
+        more than the energy of their step, so each input's difference is weighted by its row sum
+        where that exceeds 1.
+        Raises `ValueError` for other systems.
+        """
+        A = system.weighted_A
+        idx = list(system.input_nodes)
+        held = np.ones(A.shape[-1], dtype=bool)
+        held[idx] = False
+        if not (
+            (A >= 0).all()
+            and (A[..., held, :].sum(axis=-1) <= 1).all()
+            and (system.U_frac_dt_loss >= 0).all()
+            and (system.U_frac_dt_loss <= 1).all()
+        ):
+            raise ValueError(
+                "The bound only holds if no store sends out more than it holds."
+            )
+        inputs = system.inputs[: len(self.sequence) * self.steps_per_day]
+        weights = np.maximum(A[..., idx, :].sum(axis=-1), 1)
+        return (np.abs(inputs - self.expand(system.inputs)) * weights).sum(axis=(0, -1))
+
+    def simulate(self, system: EnergySystem, cycles: int = 3) -> np.ndarray:
+        """Approximate the final state of `system.simulate(FinalState())` from the representative days.
+
+        The representative days are simulated as one stack, each repeated `cycles` times from the
+        state it ends in, so that it starts from a state that repeats from day to day. Each day's
+        change is then added to the state in the order of the days it represents, within [0, U_max].
+        Sinks, e.g. OUTPUT, so add up the output of each day, while stores carry what the days
+        leave in them.
+        """
+        if cycles < 1:
+            raise ValueError(f"Need at least one cycle per day, not {cycles}.")
+        k, lead = len(self.days), system.U_max.shape[:-1]
+        n = system.U_max.shape[-1]
+        inputs = system.inputs[self._steps(self.days)].reshape(
+            k, self.steps_per_day, *system.inputs.shape[1:]
+        )
+        stack = EnergySystem.from_arrays(
+            system.g,
+            np.broadcast_to(system.U_0, (k, *lead, n)),
+            np.broadcast_to(system.U_max, (k, *lead, n)),
+            np.broadcast_to(system.U_frac_dt_loss, (k, *lead, n)),
+            np.broadcast_to(system.weighted_A, (k, *lead, n, n)),
+            np.broadcast_to(system.process_power_limits, (k, *lead, n, n)),
+            system.input_nodes,
+            np.moveaxis(inputs, 0, 1),
+            system.dt,
+            system.kernel,
+        )
+        for _ in range(cycles):
+            start = stack.U_0
+            # the state at the start of the last step, and at the end of the day
+            last = stack.simulate(FinalState(), self.steps_per_day)
+            stack.U_0 = stack.update_state(last)
+        change = stack.U_0 - start
+        u = np.broadcast_to(system.U_0, (*lead, n)).copy()
+        for c in self.sequence[:-1]:
+            u = np.clip(u + change[c], 0, system.U_max)
+        # like `simulate`, stop at the start of the last step
+        c = self.sequence[-1]
+        u = np.clip(u + last[c] - start[c], 0, system.U_max)
+        idx = list(system.input_nodes)
+        u[..., idx] = last[c][..., idx]
+        return u
+
+    def error(
+        self, system: EnergySystem, node: Optional[str] = "OUTPUT", cycles: int = 3
+    ) -> np.ndarray:
+        """The relative error of `simulate` against the full year, in `node` or in total if None."""
+        approx = self.simulate(system, cycles)
+        full = system.simulate(FinalState(), len(self.sequence) * self.steps_per_day)
+        if node is None:
+            return np.abs(approx - full).sum(axis=-1) / np.abs(full).sum(axis=-1)
+        j = system.g.inspect_ordering().index(node)
+        return np.abs(approx[..., j] - full[..., j]) / np.abs(full[..., j])
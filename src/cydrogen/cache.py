@@ -0,0 +1,288 @@
+"""Caches for hourly PV profiles and for objective evaluations.
+
+Each profile is keyed by a hash of the full request parameters and stored as a
+`.npy` array (memory-mapped on read) next to a small `.json` sidecar holding the
+rest of the response.
+"""
+import abc
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+from typing import Callable, Optional
+import numpy as np
+
+
+class CacheMiss(LookupError):
+    """Raised in offline mode when a requested profile is not in the cache."""
+
+
+class ProfileCache:
+    """A directory of hourly profiles, evicted least-recently-used once it exceeds `max_bytes`.
+
+    Parameters
+    ----------
+    directory
+        Where to keep the cache. Defaults to `$CYDROGEN_CACHE_DIR` or `~/.cache/cydrogen`.
+    max_bytes
+        Soft limit on the total size of the cache directory.
+    offline
+        If true, never call the network; a miss raises `CacheMiss`.
+        Defaults to whether `$CYDROGEN_OFFLINE` is set, other than to "", "0", "false", "no" or "off".
+    """
+
+    arrays = ("ac",)  # hourly output series stored as binary arrays
+
+    def __init__(
+        self,
+        directory: Optional[os.PathLike] = None,
+        max_bytes: int = 256 * 2**20,
+        offline: Optional[bool] = None,
+    ):
+        if directory is None:
+            directory = os.environ.get("CYDROGEN_CACHE_DIR") or (
+                pathlib.Path.home() / ".cache" / "cydrogen"
+            )
+        if offline is None:
+            value = os.environ.get("CYDROGEN_OFFLINE", "").strip().lower()
+            offline = value not in ("", "0", "false", "no", "off")
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+    @staticmethod
+    def key(params: dict) -> str:
+        """Return the content address of a request."""
+        blob = json.dumps(params, sort_keys=True, default=repr)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _paths(self, key: str):
+        return self.directory / f"{key}.json", {
+            name: self.directory / f"{key}.{name}.npy" for name in self.arrays
+        }
+
+    def get(self, params: dict) -> Optional[dict]:
+        """Return the cached response for `params`, or None if it is not cached."""
+        meta_path, array_paths = self._paths(self.key(params))
+        try:
+            with open(meta_path) as f:
+                raw = json.load(f)
+            for name, path in array_paths.items():
+                raw["outputs"][name] = np.load(path, mmap_mode="r")
+            os.utime(meta_path)  # mark as recently used
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return raw
+
+    def put(self, params: dict, raw: dict) -> None:
+        """Store a successful response, i.e. one with `outputs`."""
+        meta_path, array_paths = self._paths(self.key(params))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta = {**raw, "outputs": dict(raw["outputs"])}
+        for name, path in array_paths.items():
+            arr = np.asarray(meta["outputs"].pop(name), dtype=np.float64)
+            self._atomic_write(path, lambda f: np.save(f, arr))
+        # the sidecar is written last so that its presence marks a complete entry
+        self._atomic_write(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+        self.evict()
+
+    def _atomic_write(self, path: pathlib.Path, write: Callable):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def fetch(self, params: dict, request: Callable[[], dict]) -> dict:
+        """Return the response for `params`, calling `request` only on a cache miss.
+
+        Responses without `outputs` (e.g. rate-limiting errors) are returned but not cached.
+        """
+        raw = self.get(params)
+        if raw is not None:
+            return raw
+        if self.offline:
+            raise CacheMiss(f"No cached profile for {params} in {self.directory}.")
+        raw = request()
+        if all(name in raw.get("outputs", ()) for name in self.arrays):
+            self.put(params, raw)
+        return raw
+
+    def _entries(self):
+        """Return (last used, total bytes, files) per entry, oldest first."""
+        entries = []
+        for meta_path in self.directory.glob("*.json"):
+            _, array_paths = self._paths(meta_path.stem)
+            files = [meta_path, *array_paths.values()]
+            try:
+                mtime = meta_path.stat().st_mtime
+                size = sum(p.stat().st_size for p in files if p.exists())
+            except FileNotFoundError:  # evicted concurrently
+                continue
+            entries.append((mtime, size, files))
+        return sorted(entries, key=lambda e: e[0])
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        """Delete least-recently-used entries until the cache fits in `max_bytes`."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, files in entries:
+            if total <= self.max_bytes:
+                break
+            for p in files:
+                p.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self) -> None:
+        for _, _, files in self._entries():
+            for p in files:
+                p.unlink(missing_ok=True)
+
+
+def _to_json(value):
+    """`json.dumps` default for NumPy arrays and scalars; anything else raises `TypeError`."""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serialisable.")
+
+
+class _SQLite(abc.ABC):
+    """A connection to an SQLite database shared between processes, opened once per process
+    in WAL mode and left out when pickled (e.g. to a process pool).
+
+    Subclasses give the `SCHEMA` of their table and the `_database` path.
+    """
+
+    SCHEMA: str
+    _db = None  # (pid, connection)
+
+    @abc.abstractmethod
+    def _database(self) -> os.PathLike:
+        ...
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None or self._db[0] != os.getpid():
+            db = sqlite3.connect(self._database(), timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(f"CREATE TABLE IF NOT EXISTS {self.SCHEMA}")
+            self._db = (os.getpid(), db)
+        return self._db[1]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_db"] = None
+        return state
+
+
+class EvaluationCache(_SQLite):
+    """Memoised objective values by spend vector, kept least-recently-used in memory
+    and optionally in an SQLite file shared between processes and runs.
+
+    Parameters
+    ----------
+    maxsize
+        The number of values kept in memory.
+    digits
+        If given, spend vectors are rounded to this many significant digits before lookup,
+        so nearby points share a value. Leave as None when using finite differences.
+    path
+        An SQLite database to also read and write values from.
+    """
+
+    SCHEMA = "evaluations (key TEXT PRIMARY KEY, value REAL)"
+
+    def __init__(
+        self,
+        maxsize: int = 4096,
+        digits: Optional[int] = None,
+        path: Optional[os.PathLike] = None,
+    ):
+        self.maxsize = maxsize
+        self.digits = digits
+        self.path = path
+        self.hits = self.misses = 0
+        self._memory = collections.OrderedDict()
+
+    def key(self, xs: np.ndarray, context: Optional[dict] = None) -> str:
+        """Return the key of `xs` under the model parameters in `context`."""
+        xs = np.asarray(xs, dtype=np.float64).ravel()
+        if self.digits is None:
+            spend = [float(x).hex() for x in xs]
+        else:
+            spend = [f"{x:.{self.digits - 1}e}" for x in xs]
+        blob = json.dumps([spend, context or {}], sort_keys=True, default=repr)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _database(self) -> os.PathLike:
+        return self.path
+
+    def _remember(self, key: str, value: float):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[float]:
+        """Return the value for `key`, or None if it is not cached."""
+        value = self._memory.get(key)
+        if value is None and self.path is not None:
+            row = (
+                self._connect()
+                .execute("SELECT value FROM evaluations WHERE key = ?", (key,))
+                .fetchone()
+            )
+            value = None if row is None else row[0]
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, value)
+        return value
+
+    def put(self, key: str, value: float) -> None:
+        value = float(value)
+        self._remember(key, value)
+        if self.path is not None:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO evaluations VALUES (?, ?)", (key, value)
+            )
+
+    def info(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._memory),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self) -> None:
+        """Forget all values, including those on disk, and reset the counters."""
+        self._memory.clear()
+        self.hits = self.misses = 0
+        if self.path is not None:
+            self._connect().execute("DELETE FROM evaluations")
+
+
+_profile_cache: Optional[ProfileCache] = None
+
+
+def get_profile_cache() -> ProfileCache:
+    global _profile_cache
+    if _profile_cache is None:
+        _profile_cache = ProfileCache()
+    return _profile_cache
+
+
+def set_profile_cache(cache: ProfileCache):
+    global _profile_cache
+    _profile_cache = cache
@@ -1,11 +1,19 @@
-from typing import Any, Callable, Optional, Set, Type
+from typing import Any, Callable, Dict, Optional, Set, Tuple, Type
 import dataclasses
+import gc
+import itertools
+import types
 from ordered_set import OrderedSet
 import numpy as np
 
 
+# stamps of changes to connected components; see `Graph.compile`
+_generations = itertools.count(1)
+
+
 def id_hash(obj: object) -> int:
-    obj.__hash__ = lambda self: id(self)
+    # identity hash; object.__hash__ avoids a Python-level call per lookup
+    obj.__hash__ = object.__hash__
     return obj
 
 
@@ -20,11 +28,16 @@ class Edge:
                 raise ValueError(
                     "Cannot create duplicate edge. Use a dummy node as an intermediary."
                 )
+        self._attach(node_from, node_to, weight)
+
+    def _attach(self, node_from: "Node", node_to: "Node", weight):
+        """Link the edge into its nodes without checking for duplicates."""
         self.node_from = node_from
         self.node_to = node_to
         self.weight = weight
         node_from.edges_out.add(self)
         node_to.edges_in.add(self)
+        node_from._union(node_to)._generation = next(_generations)
 
     def __hash__(self) -> int:
         return hash((self.node_from, self.node_to, self.weight))
@@ -52,21 +65,51 @@ class Node:
     edges_in: Set["Edge"] = dataclasses.field(default_factory=set)
     edges_out: Set["Edge"] = dataclasses.field(default_factory=set)
     data: dict = dataclasses.field(default_factory=dict)
+    # union-find over connected components, updated as edges are created;
+    # the root of each component keeps the list of its members
+    _parent: Optional["Node"] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _members: Optional[list] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+    # at the root, stamped whenever an edge of the component is created or reweighted
+    _generation: int = dataclasses.field(
+        default=0, init=False, repr=False, compare=False
+    )
+
+    def _root(self) -> "Node":
+        root = self
+        while root._parent is not None:
+            root = root._parent
+        node = self
+        while node is not root:  # path compression
+            node._parent, node = root, node._parent
+        return root
+
+    def _union(self, other: "Node") -> "Node":
+        """Merge the components of two nodes, returning the root of the result."""
+        a, b = self._root(), other._root()
+        if a is b:
+            return a
+        if len(a._members or (a,)) < len(b._members or (b,)):
+            a, b = b, a
+        if a._members is None:
+            a._members = [a]
+        a._members.extend(b._members or (b,))
+        b._parent, b._members = a, None
+        return a
+
+    def component(self) -> list:
+        """Return the nodes connected to this one (ignoring edge direction), including itself."""
+        root = self._root()
+        return root._members or [root]
 
     def to_graph(self) -> "Graph":
-        nodes: OrderedSet[Node] = OrderedSet()
-        edges: Set[Node] = set()
-        stack = [self]
-        while stack:
-            node = stack.pop()
-            nodes.add(node)
-            stack.extend(
-                edge.node_from for edge in node.edges_in if edge.node_from not in nodes
-            )
-            stack.extend(
-                edge.node_to for edge in node.edges_out if edge.node_to not in nodes
-            )
-            edges |= node.edges_in | node.edges_out
+        """Return the connected component of this node, with this node first."""
+        component = self.component()
+        nodes = [self, *(node for node in component if node is not self)]
+        edges: Set[Edge] = {edge for node in component for edge in node.edges_out}
         return Graph(nodes, edges)
 
     def link_to(
@@ -87,6 +130,7 @@ class Node:
                         f"Cannot link {self} to {other} using {using or Edge} because it is already linked using {e}."
                     )
                 e.weight += weight
+                self._root()._generation = next(_generations)
                 return e
         return (using or Edge)(self, other, weight, **edge_kw)
 
@@ -94,6 +138,57 @@ class Node:
         return self.name or self.__class__.__name__
 
 
+@dataclasses.dataclass(frozen=True)
+class CompiledGraph:
+    """An immutable struct-of-arrays snapshot of a graph.
+
+    Edges are those leaving each node, ordered by source node.
+    Attribute columns are read from the nodes and edges the first time they are requested,
+    and kept in `_columns`, the only state that changes after construction.
+    """
+
+    nodes: Tuple[Node, ...]
+    edges: Tuple[Edge, ...]
+    index: types.MappingProxyType  # Node -> position in nodes
+    src: np.ndarray
+    dst: np.ndarray
+    _columns: Dict[Tuple[str, str], np.ndarray] = dataclasses.field(
+        default_factory=dict, repr=False, compare=False
+    )
+
+    @classmethod
+    def from_graph(cls, g: "Graph") -> "CompiledGraph":
+        nodes = tuple(g.nodes)
+        index = {node: i for i, node in enumerate(nodes)}
+        edges = tuple(e for node in nodes for e in node.edges_out)
+        src = np.fromiter((index[e.node_from] for e in edges), np.intp, len(edges))
+        dst = np.fromiter((index[e.node_to] for e in edges), np.intp, len(edges))
+        src.setflags(write=False)
+        dst.setflags(write=False)
+        return cls(nodes, edges, types.MappingProxyType(index), src, dst)
+
+    def _column(self, kind: str, name: str) -> np.ndarray:
+        key = (kind, name)
+        if key not in self._columns:
+            items = self.nodes if kind == "node" else self.edges
+            col = np.array([getattr(x, name) for x in items])
+            col.setflags(write=False)
+            self._columns[key] = col
+        return self._columns[key]
+
+    def node_column(self, name: str) -> np.ndarray:
+        return self._column("node", name)
+
+    def edge_column(self, name: str) -> np.ndarray:
+        return self._column("edge", name)
+
+    def adjacency(self, values=1) -> np.ndarray:
+        """Return a dense (nodes, nodes) matrix with `values` (e.g. an edge column) at each edge."""
+        arr = np.zeros((len(self.nodes), len(self.nodes)))
+        arr[self.src, self.dst] = values
+        return arr
+
+
 class Graph:
     nodes: OrderedSet[Node]
     edges: Set[Edge]
@@ -101,27 +196,49 @@ class Graph:
     def __init__(self, nodes=None, edges=None):
         self.nodes = OrderedSet(nodes or [])
         self.edges = set(edges or [])
+        self._compiled = None
 
     def add_node(self, node: Node):
         self.nodes.add(node)
+        self._compiled = None
         return node
 
     def add_edge(self, edge: Edge):
         self.edges.add(edge)
         self.nodes |= {edge.node_from, edge.node_to}
+        self._compiled = None
         return edge
 
+    def compile(self) -> CompiledGraph:
+        """Return a snapshot of the graph as arrays, cached until the graph changes.
+
+        The snapshot is stale once an edge is created or reweighted in a connected component
+        of its nodes, i.e. once the root of a component changes or is stamped anew.
+        Changes to other graphs do not affect it. Attributes mutated directly
+        (e.g. `edge.weight = ...`) are not tracked; call `invalidate` afterwards.
+        """
+        if self._compiled is None or not all(
+            root._parent is None and root._generation == generation
+            for root, generation in self._compiled[0]
+        ):
+            roots = {node._root() for node in self.nodes}
+            self._compiled = (
+                [(root, root._generation) for root in roots],
+                CompiledGraph.from_graph(self),
+            )
+        return self._compiled[1]
+
+    def invalidate(self):
+        self._compiled = None
+
     @property
     def cardinality(self):
         return len(self.nodes)
 
     def get_adjacency_matrix(self, edge_fn: Callable[[Edge], Any] = bool) -> np.ndarray:
         """Return a numpy array representing the adjacency matrix of the graph."""
-        arr = np.zeros((self.cardinality, self.cardinality))
-        for n, node in enumerate(self.nodes):
-            for edge in node.edges_out:
-                arr[n, self.nodes.index(edge.node_to)] = edge_fn(edge)
-        return arr
+        c = self.compile()
+        return c.adjacency([edge_fn(e) for e in c.edges])
 
     def node_apply(self, fn: Callable[[Node], Any]) -> None:
         return [fn(node) for node in self.nodes]
@@ -170,16 +287,51 @@ class Graph:
         self.nx_draw(edge_attrs)
         plt.show()
 
+    @classmethod
+    def from_edges(cls, src, dst, weight=None, n: Optional[int] = None):
+        """Construct a graph of `n` nodes named 0..n-1 from arrays of edge endpoints.
+
+        Duplicate edges are rejected up front, so edges are created without
+        scanning each node's existing edges.
+        """
+        src = np.asarray(src, dtype=np.intp)
+        dst = np.asarray(dst, dtype=np.intp)
+        weight = np.ones(src.shape) if weight is None else np.asarray(weight)
+        if not src.shape == dst.shape == weight.shape:
+            raise ValueError("src, dst and weight must have the same shape.")
+        if n is None:
+            n = int(max(src.max(initial=-1), dst.max(initial=-1))) + 1
+        if np.unique(src * n + dst).size != src.size:
+            raise ValueError(
+                "Cannot create duplicate edge. Use a dummy node as an intermediary."
+            )
+        # the cyclic GC would otherwise rescan the growing object graph many times
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            nodes = [Node(name=i) for i in range(n)]
+            edges = []
+            for i, j, w in zip(src.tolist(), dst.tolist(), weight.tolist()):
+                e = Edge.__new__(Edge)
+                e._attach(nodes[i], nodes[j], w)
+                edges.append(e)
+            return cls(nodes, edges)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
     @classmethod
     def from_adjacency_matrix(cls, A: np.ndarray[Any, bool]):
-        """Construct a graph from an adjacency matrix."""
-        g = cls()
-        for i in range(A.shape[0]):
-            g.add_node(Node(name=i))
-        for (i, j), val in np.ndenumerate(A):
-            if val:
-                g.add_edge(Edge(g.nodes[i], g.nodes[j], weight=val))
-        return g
+        """Construct a graph from a dense adjacency matrix or a SciPy sparse matrix."""
+        if hasattr(A, "tocoo"):  # scipy.sparse
+            A = A.tocoo()
+            nonzero = A.data != 0
+            return cls.from_edges(
+                A.row[nonzero], A.col[nonzero], A.data[nonzero], n=A.shape[0]
+            )
+        A = np.asarray(A)
+        src, dst = np.nonzero(A)
+        return cls.from_edges(src, dst, A[src, dst], n=A.shape[0])
 
     @classmethod
     def Kn(cls, n: int):
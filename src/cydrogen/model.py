@@ -4,30 +4,19 @@ Alexandros, Arselis: https://doi.org/10.1016/j.renene.2018.03.060
 H2 Storage: https://doi.org/10.1016/j.egypro.2012.09.076
 """
 import dataclasses
-import functools
 import math
 from typing import Optional, Tuple, Type
 import numpy as np
-from pypvwatts.pypvwatts import PVWatts, PVWattsResult
+from pypvwatts.pypvwatts import PVWattsResult
 from .graph import Graph, Node, Edge, id_hash
-from .units import EUR, H2_LHV, KILO, PERCENT, WH, HOUR, J, W, kWH, kW
-
-
-PVWatts.api_key = (
-    "W52N5REJOHnPbRRLbYTeue4G83bdI1DH62tOP456"
-    or "EF5VXVXX8NY0ONuhundhL5STynjc0vqhp9DsmKLz"
+from .profiles import (
+    ProfileSource,
+    get_default_profile,
+    set_pvwatts_api_key,
+    set_pvwatts_version,
 )
-PVWatts.PVWATTS_QUERY_URL = "https://developer.nrel.gov/api/pvwatts/v8.json"
-
-
-def set_pvwatts_api_key(key: str):
-    PVWatts.api_key = key
-
-
-def set_pvwatts_version(version: int):
-    PVWatts.PVWATTS_QUERY_URL = (
-        f"https://developer.nrel.gov/api/pvwatts/v{version}.json"
-    )
+from .telemetry import get_telemetry
+from .units import EUR, H2_LHV, KILO, PERCENT, WH, HOUR, J, W, kWH, kW
 
 
 ###############################################################################
@@ -117,37 +106,29 @@ class Sun(EnergyStore):
     # NOTE: it is 950 EUR / kW in the paper, but that is not a unit of energy
     specific_energy_cost: float = 950 * EUR / kW / HOUR
     installation_cost: float = 3000 * EUR
-    _request = functools.lru_cache(PVWatts.request)
 
-    def __init__(self, purchased):
+    def __init__(self, purchased, profile: Optional[ProfileSource] = None):
         super().__init__()
 
         # idk why this is needed; dataclass inheritance is pretty buggy
         self.specific_energy_cost: float = 950 * EUR / kW / HOUR
         self.installation_cost: float = 3000 * EUR
 
-        # PVWatts.request returns a dictionary with the following keys: 'inputs', 'errors', 'warnings', 'version', 'ssc_info', 'station_info', 'location', 'outputs', 'temperature_air', 'temperature_cell', 'wind_speed'
-        self.data = self._request(
-            system_capacity=(purchased - self.installation_cost)
-            / (self.specific_energy_cost * KILO * HOUR),  # Nameplate capacity (kW)
-            module_type=1,  # Module type: 0: Standard, 1: Premium, 2: Thin film
-            array_type=1,  # Array type: 0: Fixed - Open Rack, 1: Fixed - Roof Mounted, 2: 1-Axis, 3: 1-Axis Backtracking, 4: 2-Axis
-            azimuth=190,  # Azimuth angle (degrees)
-            tilt=30,  # Tilt angle (degrees)
-            dataset="intl",  # climate dataset to use
-            losses=14,  # System losses (%)
-            lat=34.88,  # latitude for the location (north/south) - Larnaca
-            lon=33.63,  # longitude for the location (west/east)- Larnaca
-            timeframe="hourly",
-        )
-        try:
-            self.inputs = self.data.raw["inputs"]
-        except KeyError as e:
-            raise RuntimeError(
-                f"Failed to access PVWatts API, rate-limiting is likely. API response: {self.data.raw}"
-            ) from e
+        self.purchased = purchased
+        self.profile = profile or get_default_profile()
+        # the profile is loaded once per source at 1 kW and rescaled to the nameplate capacity
+        with get_telemetry().span("pv_fetch"):
+            self.data = self.profile.result(self.system_capacity)
+        self.inputs = self.data.raw["inputs"]
         self.outputs = self.data.raw["outputs"]
 
+    @property
+    def system_capacity(self) -> float:
+        """Nameplate capacity (kW)."""
+        return (self.purchased - self.installation_cost) / (
+            self.specific_energy_cost * KILO * HOUR
+        )
+
 
 ###############################################################################
 
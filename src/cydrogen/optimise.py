@@ -1,33 +1,657 @@
-import warnings
 import traceback
+import multiprocessing
 import numpy as np
 import abc
+import scipy.linalg
 import scipy.optimize
-from .system import basic_system
+import scipy.stats
+from . import __version__
+from .cache import EvaluationCache
+from .profiles import get_default_profile, set_default_profile
+from .recording import FinalState
+from .system import EnergySystem, SystemTemplate, basic_system
+from .telemetry import get_telemetry
 from .units import YEARLY_HYUNDAI_NEXO_ENERGY_CONSUMPTION
 
 
+def _bounds_arrays(bounds, n: int):
+    """Lower and upper bounds as arrays, from `Bounds` or (min, max) pairs with None for unbounded."""
+    if bounds is None:
+        return np.full(n, -np.inf), np.full(n, np.inf)
+    if isinstance(bounds, scipy.optimize.Bounds):
+        return (
+            np.broadcast_to(bounds.lb, n).astype(float),
+            np.broadcast_to(bounds.ub, n).astype(float),
+        )
+    lb, ub = np.array(
+        [(-np.inf if l is None else l, np.inf if u is None else u) for l, u in bounds],
+        dtype=float,
+    ).T
+    return lb, ub
+
+
+def _fd_steps(x: np.ndarray, scheme: str, lb: np.ndarray, ub: np.ndarray):
+    """The steps and one-sidedness SciPy's `approx_derivative` uses for `x` within bounds.
+
+    Returns `(h, one_sided)`; the stencil is `x + h` for "2-point",
+    and `x - h, x + h` (or `x + h, x + 2h` where `one_sided`) for "3-point".
+    """
+    eps = np.finfo(np.float64).eps
+    rstep = eps**0.5 if scheme == "2-point" else eps ** (1 / 3)
+    sign = (x >= 0) * 2.0 - 1
+    h = rstep * sign * np.maximum(1.0, np.abs(x))
+    if scheme == "2-point":
+        one_sided = np.ones(x.shape, dtype=bool)
+    else:
+        h = np.abs(h)
+        one_sided = np.zeros(x.shape, dtype=bool)
+    if np.all(np.isneginf(lb) & np.isposinf(ub)):
+        return h, one_sided
+    lower, upper = x - lb, ub - x
+    adjusted = h.copy()
+    if scheme == "2-point":
+        # step backwards if forwards leaves the bounds, or shrink to fit the larger side
+        violated = (x + h < lb) | (x + h > ub)
+        fitting = np.abs(h) <= np.maximum(lower, upper)
+        adjusted[violated & fitting] *= -1
+        forward = (upper >= lower) & ~fitting
+        adjusted[forward] = upper[forward]
+        backward = (upper < lower) & ~fitting
+        adjusted[backward] = -lower[backward]
+    else:
+        # central where possible, otherwise one-sided towards the larger side
+        central = (lower >= h) & (upper >= h)
+        forward = (upper >= lower) & ~central
+        adjusted[forward] = np.minimum(h[forward], 0.5 * upper[forward])
+        one_sided[forward] = True
+        backward = (upper < lower) & ~central
+        adjusted[backward] = -np.minimum(h[backward], 0.5 * lower[backward])
+        one_sided[backward] = True
+        min_dist = np.minimum(upper, lower)
+        adjusted_central = ~central & (np.abs(adjusted) <= min_dist)
+        adjusted[adjusted_central] = min_dist[adjusted_central]
+        one_sided[adjusted_central] = False
+    return adjusted, one_sided
+
+
+def cma_es(
+    fun_batch,
+    x0: np.ndarray,
+    bounds=None,
+    sigma0: float = 0.3,
+    popsize: int | None = None,
+    maxiter: int = 1000,
+    ftol: float = 1e-9,
+    xtol: float = 1e-12,
+    bad_value: float | None = None,
+    seed=None,
+    callback=None,
+) -> scipy.optimize.OptimizeResult:
+    """Minimise with the covariance matrix adaptation evolution strategy, one batch per generation.
+
+    Coordinates are scaled by the width of their bounds (or by `x0` where unbounded),
+    so `sigma0` is the initial step relative to that. Candidates outside the bounds are
+    clipped to them before evaluation.
+    See Hansen, "The CMA Evolution Strategy: A Tutorial" (arXiv:1604.00772).
+
+    Parameters
+    ----------
+    fun_batch
+        Evaluates each row of a (popsize, n) array, returning (popsize,) values.
+    bad_value
+        Values at or above this (e.g. `Optimiser.BAD_VALUE`) are a penalty plateau.
+        Until a point below it is found, `ftol` and `xtol` do not stop the search,
+        and the step size doubles (up to the width of the bounds) whenever a whole generation
+        is on the plateau. If none is found, the result has `success=False`.
+    callback
+        Called with an `OptimizeResult` of the best point so far after each generation;
+        returning True or raising `StopIteration` stops the search.
+    """
+    x0 = np.asarray(x0, dtype=float)
+    n = x0.size
+    lb, ub = _bounds_arrays(bounds, n)
+    scale = np.where(np.isfinite(ub - lb), ub - lb, np.maximum(np.abs(x0), 1))
+    rng = np.random.default_rng(seed)
+
+    lam = popsize or 4 + int(3 * np.log(n))
+    mu = lam // 2
+    w = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+    w /= w.sum()
+    mueff = 1 / (w**2).sum()
+    cc = (4 + mueff / n) / (n + 4 + 2 * mueff / n)
+    cs = (mueff + 2) / (n + mueff + 5)
+    c1 = 2 / ((n + 1.3) ** 2 + mueff)
+    cmu = min(1 - c1, 2 * (mueff - 2 + 1 / mueff) / ((n + 2) ** 2 + mueff))
+    damps = 1 + 2 * max(0, np.sqrt((mueff - 1) / (n + 1)) - 1) + cs
+    chiN = n**0.5 * (1 - 1 / (4 * n) + 1 / (21 * n**2))
+
+    mean, sigma = x0 / scale, sigma0
+    pc, ps = np.zeros(n), np.zeros(n)
+    B, D, C = np.eye(n), np.ones(n), np.eye(n)
+    best = scipy.optimize.OptimizeResult(x=x0, fun=np.inf)
+    nfev, message = 0, "Maximum number of iterations reached."
+    for it in range(1, maxiter + 1):
+        y = rng.standard_normal((lam, n)) * D @ B.T
+        X = np.clip((mean + sigma * y) * scale, lb, ub)
+        f = np.asarray(fun_batch(X), dtype=float)
+        nfev += lam
+        order = np.argsort(f)
+        if f[order[0]] < best.fun:
+            best = scipy.optimize.OptimizeResult(x=X[order[0]], fun=f[order[0]])
+        # the steps actually taken, after clipping
+        y = (X / scale - mean) / sigma
+        old = mean
+        mean = mean + sigma * (w @ y[order[:mu]])
+        step = (mean - old) / sigma
+        ps = (1 - cs) * ps + np.sqrt(cs * (2 - cs) * mueff) * (B @ ((B.T @ step) / D))
+        hsig = np.linalg.norm(ps) / np.sqrt(
+            1 - (1 - cs) ** (2 * it)
+        ) / chiN < 1.4 + 2 / (n + 1)
+        pc = (1 - cc) * pc + hsig * np.sqrt(cc * (2 - cc) * mueff) * step
+        ysel = y[order[:mu]]
+        C = (
+            (1 - c1 - cmu) * C
+            + c1 * (np.outer(pc, pc) + (1 - hsig) * cc * (2 - cc) * C)
+            + cmu * (ysel.T * w) @ ysel
+        )
+        sigma *= np.exp((cs / damps) * (np.linalg.norm(ps) / chiN - 1))
+        D2, B = np.linalg.eigh((C + C.T) / 2)
+        D = np.sqrt(np.maximum(D2, 1e-300))
+        best.nit, best.nfev = it, nfev
+        try:
+            if callback is not None and callback(best):
+                raise StopIteration
+        except StopIteration:
+            message = "`callback` requested a stop."
+            break
+        if bad_value is not None and best.fun >= bad_value:
+            # search wider rather than converge on the plateau
+            if f[order[0]] >= bad_value:
+                sigma = min(2 * sigma, max(sigma0, 1.0))
+            continue
+        if f[order[-1]] - f[order[0]] <= ftol * max(1, abs(f[order[0]])):
+            message = "Population values converged within `ftol`."
+            break
+        if sigma * D.max() <= xtol:
+            message = "Step size fell below `xtol`."
+            break
+    best.success = not message.startswith("Maximum")
+    if bad_value is not None and best.fun >= bad_value:
+        best.success = False
+        message = "No value below `bad_value` was found."
+    best.message = message
+    best.nit, best.nfev = it, nfev
+    return best
+
+
+def _gp_fit(U: np.ndarray, y: np.ndarray):
+    """Fit a Gaussian process with a squared-exponential kernel to `y` at the rows of `U`.
+
+    The length scale is chosen from a grid by marginal likelihood.
+    Returns a function giving the predictive mean and standard deviation at the rows of its input.
+    """
+    mu, sd = y.mean(), y.std() or 1.0
+    z = (y - mu) / sd
+    d2 = ((U[:, None, :] - U[None, :, :]) ** 2).sum(axis=-1)
+    best = None
+    for ell in np.logspace(-2, 0.5, 16):
+        K = np.exp(-0.5 * d2 / ell**2) + 1e-6 * np.eye(len(U))
+        try:
+            L = np.linalg.cholesky(K)
+        except np.linalg.LinAlgError:
+            continue
+        alpha = scipy.linalg.cho_solve((L, True), z)
+        nll = 0.5 * z @ alpha + np.log(np.diag(L)).sum()
+        if best is None or nll < best[0]:
+            best = (nll, ell, L, alpha)
+    _, ell, L, alpha = best
+
+    def predict(V: np.ndarray):
+        Ks = np.exp(
+            -0.5 * ((V[:, None, :] - U[None, :, :]) ** 2).sum(axis=-1) / ell**2
+        )
+        v = scipy.linalg.solve_triangular(L, Ks.T, lower=True)
+        var = np.maximum(1 - (v**2).sum(axis=0), 1e-12)
+        return mu + sd * (Ks @ alpha), sd * np.sqrt(var)
+
+    return predict
+
+
+def surrogate_minimise(
+    fun_batch,
+    x0: np.ndarray,
+    bounds,
+    maxiter: int = 30,
+    n_initial: int | None = None,
+    batch: int = 1,
+    candidates: int = 2048,
+    tol: float = 1e-6,
+    bad_value: float | None = None,
+    history: tuple | None = None,
+    seed=None,
+    callback=None,
+) -> scipy.optimize.OptimizeResult:
+    """Minimise an expensive function by Bayesian optimisation with a Gaussian-process surrogate.
+
+    Every evaluation so far is used to fit the surrogate; each iteration then evaluates only the
+    `batch` candidates with the largest expected improvement.
+
+    Parameters
+    ----------
+    fun_batch
+        Evaluates each row of an (m, n) array, returning (m,) values.
+    bounds
+        Finite bounds on every variable; the surrogate is fitted on the unit cube.
+    n_initial
+        The size of the initial Latin hypercube design, evaluated together with `x0`; 2n + 1 by default.
+    tol
+        Stop once the expected improvement is below this fraction of the spread of the values.
+    bad_value
+        Values at or above this (e.g. `Optimiser.BAD_VALUE`) are left out of the surrogate,
+        so that penalty plateaus do not swamp it; instead the expected improvement is weighted by
+        the chance of avoiding them, from a second fit to which points were penalised.
+        The result is unsuccessful if no value below it was found.
+    history
+        Previous evaluations `(X, y)` to include without re-evaluating, e.g. `(r.X, r.y)`
+        of an earlier result.
+    callback
+        Called with an `OptimizeResult` of the best point so far after each iteration;
+        returning True or raising `StopIteration` stops the search.
+    """
+    x0 = np.asarray(x0, dtype=float)
+    n = x0.size
+    lb, ub = _bounds_arrays(bounds, n)
+    if not np.isfinite(ub - lb).all():
+        raise ValueError("The surrogate method requires finite bounds.")
+    rng = np.random.default_rng(seed)
+
+    design = scipy.stats.qmc.LatinHypercube(d=n, seed=rng).random(
+        n_initial or 2 * n + 1
+    )
+    X = np.vstack([np.clip(x0, lb, ub), lb + design * (ub - lb)])
+    y = np.asarray(fun_batch(X), dtype=float)
+    nfev = len(X)
+    if history is not None:
+        X = np.vstack([np.asarray(history[0], dtype=float), X])
+        y = np.concatenate([np.asarray(history[1], dtype=float), y])
+
+    message = "Maximum number of iterations reached."
+    for it in range(1, maxiter + 1):
+        U = (X - lb) / (ub - lb)
+        U, first = np.unique(U, axis=0, return_index=True)
+        fit = y[first]
+        ok = np.ones(len(U), dtype=bool) if bad_value is None else fit < bad_value
+        if not ok.any():
+            ok[:] = True
+        predict = _gp_fit(U[ok], fit[ok])
+        best_u = U[ok][np.argmin(fit[ok])]
+        # explore the whole box and refine around the incumbent at several scales
+        local = (
+            best_u
+            + rng.standard_normal((candidates // 2, n))
+            * np.repeat([0.1, 0.01, 0.001], -(-candidates // 6))[
+                : candidates // 2, None
+            ]
+        )
+        C = np.vstack([rng.random((candidates // 2, n)), np.clip(local, 0, 1)])
+        m, sd = predict(C)
+        f_best = fit[ok].min()
+        z = (f_best - m) / sd
+        ei = (f_best - m) * scipy.stats.norm.cdf(z) + sd * scipy.stats.norm.pdf(z)
+        if not ok.all():
+            # weight by the chance of avoiding a penalty, from a second fit to the outcomes
+            m_ok, sd_ok = _gp_fit(U, ok.astype(float))(C)
+            ei *= scipy.stats.norm.cdf((m_ok - 0.5) / sd_ok)
+        if ei.max() <= tol * (np.ptp(fit[ok]) or 1):
+            message = "Expected improvement fell below `tol`."
+            break
+        picks = np.argsort(ei)[::-1][:batch]
+        Xn = lb + C[picks] * (ub - lb)
+        yn = np.asarray(fun_batch(Xn), dtype=float)
+        nfev += len(Xn)
+        X, y = np.vstack([X, Xn]), np.concatenate([y, yn])
+        k = np.argmin(y)
+        result = scipy.optimize.OptimizeResult(x=X[k], fun=y[k], nit=it, nfev=nfev)
+        try:
+            if callback is not None and callback(result):
+                raise StopIteration
+        except StopIteration:
+            message = "`callback` requested a stop."
+            break
+    k = np.argmin(y)
+    success = True
+    if bad_value is not None and y[k] >= bad_value:
+        success = False
+        message = "No value below `bad_value` was found."
+    return scipy.optimize.OptimizeResult(
+        x=X[k],
+        fun=y[k],
+        nit=it if maxiter else 0,
+        nfev=nfev,
+        X=X,
+        y=y,
+        success=success,
+        message=message,
+    )
+
+
 class Optimiser(abc.ABC):
+    """Wraps `scipy.optimize.minimize` around `objective`.
+
+    If `options["jac"]` is "2-point" or "3-point", the finite differences are computed by
+    `gradient` instead of SciPy, which evaluates the whole stencil at once with `objective_batch`;
+    the result is the same jacobian as SciPy's. With a custom `options["fun"]`, they are left to SciPy.
+    If it is "exact", the gradient from `value_and_jac` is used instead, for subclasses that have one.
+
+    A process pool for `workers` is shut down at the end of each run, or by `close`;
+    optimisers are also context managers that close it on exit.
+
+    `options["method"]` may also be "differential-evolution" (`scipy.optimize.differential_evolution`)
+    or "cma-es" (`cma_es`); these population-based global methods evaluate each generation
+    in one call to `objective_batch`, and take their settings from `options["options"]`.
+    Likewise "surrogate" (`surrogate_minimise`) only simulates the candidates that a Gaussian-process
+    fit to all previous evaluations expects to improve the most.
+
+    Parameters
+    ----------
+    options
+        Keyword arguments for `scipy.optimize.minimize`.
+    workers
+        If given, evaluate batches over a process pool of this size,
+        or with this map-like callable (e.g. `multiprocessing.Pool(4).map`).
+    cache
+        If given, objective values are looked up here first, keyed by `xs` and `cache_context`;
+        this covers `evaluate`, `objective_batch` and everything built on them.
+        Values where `objective` raised are returned as `BAD_VALUE` but not cached.
+    """
+
     BAD_VALUE = 1e20
+    # bump when a change to the model or the objectives changes their values,
+    # so that cached values from before are not reused
+    CACHE_SCHEMA = 1
+    verbose = True  # print each iterate as well as recording it
 
-    def __init__(self, options: dict):
+    def __init__(
+        self, options: dict, workers=None, cache: EvaluationCache | None = None
+    ):
         self.options = options.copy()
-        self.options.setdefault("fun", self.objective)
+        custom_fun = "fun" in self.options
+        self.options.setdefault("fun", self.evaluate)
         self.options.setdefault("method", "Nelder-Mead")
         self.options.setdefault("callback", self.callback)
+        self.workers = workers
+        self.cache = cache
+        self._pool = None
+        self._template = None
+        self._failures = 0
+        self.fd_scheme = None
+        if self.options.get("jac") in ("2-point", "3-point") and not custom_fun:
+            self.fd_scheme = self.options["jac"]
+            # f(x) is evaluated in the same batch as the stencil
+            self.options["fun"] = self.value_and_gradient
+            self.options["jac"] = True
+        elif self.options.get("jac") == "exact":
+            if custom_fun:
+                raise ValueError(
+                    'jac="exact" is the gradient of `objective`, not of a custom `fun`.'
+                )
+            if not hasattr(self, "value_and_jac"):
+                raise ValueError(f"{type(self).__name__} has no exact gradient.")
+            self.options["fun"] = self.value_and_jac
+            self.options["jac"] = True
 
     @abc.abstractmethod
     def objective(self, xs: np.ndarray) -> np.ndarray:
-        ...
+        """The value to minimise at `xs`, or `BAD_VALUE` where it is infeasible.
+
+        Exceptions are recorded with `_failed` and turned into `BAD_VALUE`,
+        here or by `evaluate` and `objective_batch`.
+        """
+
+    def _map(self, fn, iterable) -> list:
+        if self.workers is None:
+            return list(map(fn, iterable))
+        if callable(self.workers):
+            return list(self.workers(fn, iterable))
+        # workers started by "spawn" or "forkserver" do not inherit the default profile
+        profile = get_default_profile()
+        if self._pool is not None and self._pool[0] is not profile:
+            self.close()
+        if self._pool is None:
+            self._pool = (
+                profile,
+                multiprocessing.Pool(
+                    self.workers, initializer=set_default_profile, initargs=(profile,)
+                ),
+            )
+        return self._pool[1].map(fn, iterable)
+
+    def close(self):
+        """Shut down the process pool, if any."""
+        if self._pool is not None:
+            self._pool[1].terminate()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def template(self) -> SystemTemplate:
+        """`basic_system` compiled once, and again only if the default profile changes."""
+        profile = get_default_profile()
+        if self._template is None or self._template[0] is not profile:
+            self._template = (profile, SystemTemplate.basic())
+        return self._template[1]
+
+    def cache_context(self) -> dict:
+        """The model parameters that, besides `xs`, determine the objective."""
+        return {
+            "objective": type(self).__qualname__,
+            "schema": self.CACHE_SCHEMA,
+            "version": __version__,
+            "profile": get_default_profile().fingerprint(),
+        }
+
+    def _failed(self, e: Exception):
+        """Record an exception that is turned into `BAD_VALUE`."""
+        self._failures += 1
+        get_telemetry().count(
+            "failure", error=repr(e), traceback=traceback.format_exc()
+        )
+
+    def _build_invalid(self, spends: np.ndarray):
+        """Fail on spends that `template` rejects (e.g. no PV) by building them with `basic_system`,
+        so that the failure is recorded just as without the template."""
+        basic_system(*spends)
+        raise ValueError("PV capacity must be positive.")
+
+    def _safe_objective(self, xs: np.ndarray) -> float:
+        """`objective`, or NaN if it failed, so that the failure is not cached."""
+        failures = self._failures
+        try:
+            value = self.objective(xs)
+        except MemoryError:
+            raise
+        except Exception as e:
+            self._failed(e)
+        return np.nan if self._failures != failures else value
+
+    def _record(self, values, hits: int = 0, misses: int = 0):
+        telemetry = get_telemetry()
+        if hits:
+            telemetry.count("cache_hit", hits)
+        if misses:
+            telemetry.count("cache_miss", misses)
+        penalties = int(np.count_nonzero(np.asarray(values) == self.BAD_VALUE))
+        if penalties:
+            telemetry.count("penalty", penalties)
+
+    def evaluate(self, xs: np.ndarray) -> float:
+        """`objective`, looked up in the cache if any."""
+        with get_telemetry().span("evaluation"):
+            if self.cache is None:
+                value = self._safe_objective(xs)
+                value = self.BAD_VALUE if np.isnan(value) else value
+                self._record(value)
+                return value
+            key = self.cache.key(xs, self.cache_context())
+            value = self.cache.get(key)
+            if value is None:
+                value = self._safe_objective(xs)
+                if np.isnan(value):
+                    value = self.BAD_VALUE
+                else:
+                    self.cache.put(key, value)
+                self._record(value, misses=1)
+            else:
+                self._record(value, hits=1)
+            return value
+
+    def objective_batch(self, X: np.ndarray) -> np.ndarray:
+        """Evaluate the objective at each row of `X`, computing only those not in the cache."""
+        X = np.asarray(X, dtype=float)
+        with get_telemetry().span("evaluation", batch=len(X)):
+            if self.cache is None:
+                out = self._objective_batch(X)
+                out[np.isnan(out)] = self.BAD_VALUE
+                self._record(out)
+                return out
+            context = self.cache_context()
+            keys = [self.cache.key(xs, context) for xs in X]
+            out = np.array([self.cache.get(k) for k in keys], dtype=float)
+            todo = np.flatnonzero(np.isnan(out))
+            if todo.size:
+                out[todo] = self._objective_batch(X[todo])
+                for i in todo:
+                    if np.isnan(out[i]):
+                        out[i] = self.BAD_VALUE
+                    else:
+                        self.cache.put(keys[i], out[i])
+            self._record(out, hits=len(X) - todo.size, misses=todo.size)
+            return out
+
+    def _objective_batch(self, X: np.ndarray) -> np.ndarray:
+        """Evaluate `objective` at each row of `X`, over the workers if any; NaN where it raised."""
+        return np.array(self._map(self._safe_objective, list(X)), dtype=float)
+
+    def _stencil(self, xs: np.ndarray, scheme: str):
+        xs = np.asarray(xs, dtype=float)
+        lb, ub = _bounds_arrays(self.options.get("bounds"), xs.size)
+        h, one_sided = _fd_steps(xs, scheme, lb, ub)
+        eye = np.eye(xs.size)
+        if scheme == "2-point":
+            points = [xs + eye * h[:, None]]
+        else:
+            points = [
+                xs + eye * np.where(one_sided, 1, -1)[:, None] * h[:, None],
+                xs + eye * np.where(one_sided, 2, 1)[:, None] * h[:, None],
+            ]
+        return xs, points, one_sided
+
+    @staticmethod
+    def _differences(xs, f0, fs, points, one_sided, scheme):
+        # divide by the representable step, as SciPy does
+        if scheme == "2-point":
+            (x1,) = points
+            return (fs[0] - f0) / (np.diag(x1) - xs)
+        x1, x2 = points
+        return np.where(
+            one_sided,
+            (-3.0 * f0 + 4 * fs[0] - fs[1]) / (np.diag(x2) - xs),
+            (fs[1] - fs[0]) / (np.diag(x2) - np.diag(x1)),
+        )
+
+    def value_and_gradient(self, xs: np.ndarray, scheme: str | None = None):
+        """Return `objective(xs)` and its finite-difference gradient, from a single batch."""
+        scheme = scheme or self.fd_scheme or "2-point"
+        xs, points, one_sided = self._stencil(xs, scheme)
+        fs = self.objective_batch(np.concatenate([xs[None], *points]))
+        f0, fs = fs[0], fs[1:].reshape(len(points), xs.size)
+        return f0, self._differences(xs, f0, fs, points, one_sided, scheme)
+
+    def gradient(
+        self, xs: np.ndarray, scheme: str | None = None, f0: float | None = None
+    ) -> np.ndarray:
+        """The finite-difference gradient of `objective` at `xs`, as SciPy would compute it.
+
+        Steps follow `scipy.optimize.approx_derivative` with the default relative step,
+        including switching to one-sided differences at the `bounds` in `options`.
+        The whole stencil is evaluated in one call to `objective_batch`.
+        """
+        if f0 is None:
+            return self.value_and_gradient(xs, scheme)[1]
+        scheme = scheme or self.fd_scheme or "2-point"
+        xs, points, one_sided = self._stencil(xs, scheme)
+        fs = self.objective_batch(np.concatenate(points))
+        fs = fs.reshape(len(points), xs.size)
+        return self._differences(xs, f0, fs, points, one_sided, scheme)
 
     def callback(self, intermediate_result):
-        print(f"f{tuple(intermediate_result.x)}={intermediate_result.fun}")
+        get_telemetry().event(
+            "iterate",
+            x=list(map(float, intermediate_result.x)),
+            fun=float(intermediate_result.fun),
+        )
+        if self.verbose:
+            print(f"f{tuple(intermediate_result.x)}={intermediate_result.fun}")
+
+    def _population_batch(self, X: np.ndarray) -> np.ndarray:
+        # SciPy's `vectorized=True` passes candidates as columns
+        return self.objective_batch(X.T)
 
     def __call__(self):
-        return scipy.optimize.minimize(**self.options)
+        try:
+            return self._run()
+        finally:
+            self.close()
 
     optimise = __call__
 
+    def _run(self):
+        method = self.options["method"]
+        settings = dict(self.options.get("options") or {})
+        if method == "differential-evolution":
+            if self.options.get("bounds") is None:
+                raise ValueError("Differential evolution requires finite bounds.")
+            lb, ub = _bounds_arrays(self.options["bounds"], len(self.options["bounds"]))
+            if not np.isfinite(ub - lb).all():
+                raise ValueError("Differential evolution requires finite bounds.")
+            settings.setdefault("updating", "deferred")
+            return scipy.optimize.differential_evolution(
+                self._population_batch,
+                scipy.optimize.Bounds(lb, ub),
+                x0=self.options.get("x0"),
+                callback=self.options.get("callback"),
+                vectorized=True,
+                **settings,
+            )
+        if method == "cma-es":
+            settings.setdefault("bad_value", self.BAD_VALUE)
+            return cma_es(
+                self.objective_batch,
+                self.options["x0"],
+                self.options.get("bounds"),
+                callback=self.options.get("callback"),
+                **settings,
+            )
+        if method == "surrogate":
+            settings.setdefault("bad_value", self.BAD_VALUE)
+            return surrogate_minimise(
+                self.objective_batch,
+                self.options["x0"],
+                self.options.get("bounds"),
+                callback=self.options.get("callback"),
+                **settings,
+            )
+        return scipy.optimize.minimize(**self.options)
+
 
 class BudgetAllocator(Optimiser):
     """Given a total budget, allocate it between the PV, battery, electrolyser and hydrogen storage.
@@ -51,23 +675,90 @@ class BudgetAllocator(Optimiser):
 
     total_budget: float | None = None
 
+    def _spends(self, X: np.ndarray) -> np.ndarray:
+        """The PV, battery, electrolyser and hydrogen store spends for (rows of) budget fractions."""
+        X = np.asarray(X, dtype=float)
+        # the hydrogen store gets the rest of the budget
+        h2_store_spend = (1 - X.sum(axis=-1, keepdims=True)) * self.total_budget
+        return np.concatenate([X * self.total_budget, h2_store_spend], axis=-1)
+
+    def _system(self, xs: np.ndarray) -> EnergySystem | None:
+        """The system with its object graph, as needed for `sensitivity`."""
+        spends = self._spends(xs)
+        if spends[-1] < 0:
+            return None
+        try:
+            return basic_system(*spends)
+        except Exception as e:
+            self._failed(e)
+            return None
+
     def objective(self, xs: np.ndarray):
-        pv_spend, battery_spend, electrolyser_spend = xs * self.total_budget
-        h2_store_spend = (1 - xs.sum()) * self.total_budget
-        if h2_store_spend < 0:
+        spends = self._spends(xs)
+        if spends[-1] < 0:
             return self.BAD_VALUE
         try:
-            s = basic_system(
-                pv_spend, battery_spend, electrolyser_spend, h2_store_spend
-            )
-            s.simulate()
-        except Exception:
+            if not self.template().valid(spends):
+                self._build_invalid(spends)
+            s = self.template()(spends)
+            s.simulate(FinalState())
+        except MemoryError:
+            raise
+        except Exception as e:
+            self._failed(e)
             return self.BAD_VALUE
-
         # maximise output, so minimise -output
-        o = s.us[-1, s.g.inspect_ordering().index("OUTPUT")]
+        o = s.total_useful
         return self.BAD_VALUE if o <= 0 else -o
 
+    def value_and_jac(self, xs: np.ndarray):
+        """The objective and its gradient from `EnergySystem.sensitivity`; zero where it is `BAD_VALUE`."""
+        s = self._system(xs)
+        if s is None:
+            return self.BAD_VALUE, np.zeros(len(xs))
+        try:
+            d = s.sensitivity()
+        except Exception as e:
+            self._failed(e)
+            return self.BAD_VALUE, np.zeros(len(xs))
+        o = s.total_useful
+        if o <= 0:
+            return self.BAD_VALUE, np.zeros(len(xs))
+        do = d[s.g.inspect_ordering().index("OUTPUT")]
+        # xs are fractions of the budget; the hydrogen store gets the rest
+        return -o, -self.total_budget * (do[:3] - do[3])
+
+    def jac(self, xs: np.ndarray) -> np.ndarray:
+        return self.value_and_jac(xs)[1]
+
+    def cache_context(self) -> dict:
+        return {**super().cache_context(), "total_budget": self.total_budget}
+
+    def _objective_batch(self, X: np.ndarray) -> np.ndarray:
+        """Without workers, simulate all rows of `X` as one stacked system.
+
+        If that raises, the rows are evaluated one by one to find those that fail.
+        """
+        if self.workers is not None:
+            return super()._objective_batch(X)
+        out = np.full(len(X), float(self.BAD_VALUE))
+        spends = self._spends(X)
+        valid = self.template().valid(spends)
+        ok = (spends[:, -1] >= 0) & valid
+        for i in np.flatnonzero((spends[:, -1] >= 0) & ~valid):
+            out[i] = self._safe_objective(X[i])
+        if ok.any():
+            try:
+                s = self.template()(spends[ok])
+                s.simulate(FinalState())
+            except MemoryError:
+                raise
+            except Exception:
+                return super()._objective_batch(X)
+            o = s.total_useful
+            out[ok] = np.where(o <= 0, self.BAD_VALUE, -o)
+        return out
+
 
 class MinimiseHEVBudget(Optimiser):
     """Minimise the budget for the hydrogen energy system require to satisfy a given energy demand.
@@ -91,16 +782,80 @@ class MinimiseHEVBudget(Optimiser):
 
     output_limit: float
 
+    def output(self, xs: np.ndarray) -> float:
+        """The yearly useful output of the system bought by `xs`."""
+        return self._output_and_jac(xs)[0]
+
+    def output_jac(self, xs: np.ndarray) -> np.ndarray:
+        """The exact gradient of `output`, from `EnergySystem.sensitivity`."""
+        return self._output_and_jac(xs)[1]
+
+    def _output_and_jac(self, xs: np.ndarray):
+        # constraint functions and their jacobians are requested at the same points
+        xs = np.asarray(xs, dtype=float)
+        last = getattr(self, "_last_output", None)
+        if last is None or not np.array_equal(last[0], xs):
+            if not self.template().valid(xs):
+                # no PV is bought, so nothing is produced whatever the other spends
+                last = (xs.copy(), 0.0, np.zeros(len(xs)))
+            else:
+                s = basic_system(*xs)
+                d = s.sensitivity()
+                last = (
+                    xs.copy(),
+                    s.total_useful,
+                    d[s.g.inspect_ordering().index("OUTPUT")],
+                )
+            self._last_output = last
+        return last[1], last[2]
+
+    def constraint(self) -> scipy.optimize.NonlinearConstraint:
+        """`output(xs) >= output_limit`, with its exact jacobian.
+
+        For constrained methods, minimising the plain budget instead of the penalised objective:
+        ```py
+        opt.options.update(
+            fun=np.sum, jac=np.ones_like, method="SLSQP", constraints=[opt.constraint()]
+        )
+        ```
+        """
+        return scipy.optimize.NonlinearConstraint(
+            self.output, self.output_limit, np.inf, jac=self.output_jac
+        )
+
     def objective(self, xs: np.ndarray):
         try:
-            s = basic_system(*xs)
-            s.simulate()
+            if not self.template().valid(xs):
+                self._build_invalid(xs)
+            # stops as soon as feasibility is known
+            feasible = self.template()(xs).reaches(self.output_limit)
+        except MemoryError:
+            raise
         except Exception as e:
-            warnings.warn(f"Ignoring exception {e} that occurred.")
-            traceback.print_exc()
+            self._failed(e)
             return self.BAD_VALUE
-        return (
-            sum(xs)
-            if s.us[-1, s.g.inspect_ordering().index("OUTPUT")] > self.output_limit
-            else self.BAD_VALUE
-        )
+        return sum(xs) if feasible else self.BAD_VALUE
+
+    def cache_context(self) -> dict:
+        return {**super().cache_context(), "output_limit": self.output_limit}
+
+    def _objective_batch(self, X: np.ndarray) -> np.ndarray:
+        """Without workers, check the feasibility of all rows of `X` as one stacked system.
+
+        If that raises, the rows are evaluated one by one to find those that fail.
+        """
+        if self.workers is not None:
+            return super()._objective_batch(X)
+        out = np.full(len(X), float(self.BAD_VALUE))
+        ok = self.template().valid(X)
+        for i in np.flatnonzero(~ok):
+            out[i] = self._safe_objective(X[i])
+        if ok.any():
+            try:
+                feasible = self.template()(X[ok]).reaches(self.output_limit)
+            except MemoryError:
+                raise
+            except Exception:
+                return super()._objective_batch(X)
+            out[ok] = np.where(feasible, X[ok].sum(axis=1), self.BAD_VALUE)
+        return out
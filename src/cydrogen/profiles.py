@@ -0,0 +1,337 @@
+"""Hourly PV output profiles, normalised to 1 kW of nameplate capacity.
+
+PV output is linear in `system_capacity`, so a site only needs to be requested or loaded once;
+any other capacity is then a rescaling of the per-kW profile.
+Profiles come either from the PVWatts API or from local files, which allows running offline.
+"""
+import abc
+import concurrent.futures
+import dataclasses
+import datetime
+import email.utils
+import functools
+import hashlib
+import os
+import random
+import threading
+import time
+from typing import Dict, Iterable, Optional, Union
+import numpy as np
+import requests
+from pypvwatts.pypvwatts import PVWatts, PVWattsResult
+from .cache import get_profile_cache
+from .telemetry import get_telemetry
+
+
+PVWatts.api_key = (
+    "W52N5REJOHnPbRRLbYTeue4G83bdI1DH62tOP456"
+    or "EF5VXVXX8NY0ONuhundhL5STynjc0vqhp9DsmKLz"
+)
+PVWatts.PVWATTS_QUERY_URL = "https://developer.nrel.gov/api/pvwatts/v8.json"
+
+
+def set_pvwatts_api_key(key: str):
+    PVWatts.api_key = key
+
+
+def set_pvwatts_version(version: int):
+    PVWatts.PVWATTS_QUERY_URL = (
+        f"https://developer.nrel.gov/api/pvwatts/v{version}.json"
+    )
+
+
+def request_pvwatts(**params) -> PVWattsResult:
+    """`PVWatts.request`, backed by the on-disk profile cache."""
+    key = {"url": PVWatts.PVWATTS_QUERY_URL, **params}
+    return PVWattsResult(
+        get_profile_cache().fetch(key, lambda: PVWatts.request(**params).raw)
+    )
+
+
+# outputs that scale with nameplate capacity; the rest (e.g. solrad, capacity_factor) do not
+LINEAR_OUTPUTS = ("ac", "ac_annual", "ac_monthly", "dc", "dc_monthly")
+
+
+class ProfileSource(abc.ABC):
+    """A source of hourly AC output per kW of nameplate capacity, as used by `Sun`."""
+
+    @abc.abstractmethod
+    def per_kw(self) -> np.ndarray:
+        """Hourly AC output (W) per kW of nameplate capacity."""
+
+    def fingerprint(self) -> str:
+        """A hash of the profile, e.g. for keying cached evaluations."""
+        ac = np.ascontiguousarray(self.per_kw(), dtype=np.float64)
+        return hashlib.sha256(ac.tobytes()).hexdigest()
+
+    def result(self, system_capacity: float) -> PVWattsResult:
+        """Return a PVWatts-like result for `system_capacity` kW."""
+        if system_capacity <= 0:
+            raise ValueError(f"PV capacity must be positive, not {system_capacity} kW.")
+        ac = self.per_kw() * system_capacity
+        return PVWattsResult(
+            {
+                "inputs": {"system_capacity": system_capacity},
+                "outputs": {"ac": ac, "ac_annual": ac.sum() / 1000},  # kWh
+            }
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class PVWattsProfile(ProfileSource):
+    """A PV installation at a site, whose hourly AC output is fetched once at 1 kW."""
+
+    module_type: int = 1  # Module type: 0: Standard, 1: Premium, 2: Thin film
+    array_type: int = 1  # Array type: 0: Fixed - Open Rack, 1: Fixed - Roof Mounted, 2: 1-Axis, 3: 1-Axis Backtracking, 4: 2-Axis
+    azimuth: float = 190  # Azimuth angle (degrees)
+    tilt: float = 30  # Tilt angle (degrees)
+    dataset: str = "intl"  # climate dataset to use
+    losses: float = 14  # System losses (%)
+    lat: float = 34.88  # latitude for the location (north/south) - Larnaca
+    lon: float = 33.63  # longitude for the location (west/east)- Larnaca
+
+    def params(self) -> dict:
+        """The PVWatts request parameters for a 1 kW system."""
+        return dict(system_capacity=1, timeframe="hourly", **dataclasses.asdict(self))
+
+    @functools.lru_cache
+    def reference(self) -> PVWattsResult:
+        """The PVWatts response for a 1 kW system."""
+        result = request_pvwatts(**self.params())
+        if "inputs" not in result.raw:
+            raise RuntimeError(
+                f"Failed to access PVWatts API, rate-limiting is likely. API response: {result.raw}"
+            )
+        return result
+
+    def per_kw(self) -> np.ndarray:
+        return np.asarray(self.reference().outputs["ac"], dtype=np.float64)
+
+    def fingerprint(self) -> str:
+        # the request itself identifies the profile, without fetching it
+        return f"{PVWatts.PVWATTS_QUERY_URL} {self!r}"
+
+    def result(self, system_capacity: float) -> PVWattsResult:
+        """Like `ProfileSource.result`, but keeping the rest of the PVWatts response."""
+        if system_capacity <= 0:
+            raise ValueError(f"PV capacity must be positive, not {system_capacity} kW.")
+        ref = self.reference().raw
+        outputs = dict(ref["outputs"])
+        for name in LINEAR_OUTPUTS:
+            if name in outputs:
+                outputs[name] = np.asarray(outputs[name]) * system_capacity
+        return PVWattsResult(
+            {
+                **ref,
+                "inputs": {**ref["inputs"], "system_capacity": system_capacity},
+                "outputs": outputs,
+            }
+        )
+
+
+class RateLimited(RuntimeError):
+    """PVWatts kept refusing requests for exceeding the rate limit."""
+
+
+def _rate_limited(response: requests.Response, raw: dict) -> bool:
+    error = raw.get("error") if isinstance(raw, dict) else None
+    return response.status_code == 429 or (
+        isinstance(error, dict) and error.get("code") == "OVER_RATE_LIMIT"
+    )
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    """The seconds to wait from a `Retry-After` header, in seconds or as an HTTP date."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(
+        0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    )
+
+
+def prefetch_profiles(
+    profiles: Iterable[PVWattsProfile],
+    workers: int = 8,
+    retries: int = 6,
+    backoff: float = 2.0,
+    timeout: float = 60.0,
+) -> Dict[PVWattsProfile, Union[np.ndarray, Exception]]:
+    """Fetch the profiles of many sites concurrently into the profile cache.
+
+    Requests are made by `workers` threads, each reusing its own HTTP connection.
+    A rate-limited response (HTTP 429 or error code "OVER_RATE_LIMIT") pauses all threads for
+    the server's `Retry-After` (in seconds or as a date), or else, if it has none or it cannot be
+    parsed, for `backoff * 2**attempt` seconds with some jitter,
+    after which the request is retried up to `retries` times.
+    Profiles that are already cached are not requested, so an interrupted prefetch can be rerun.
+
+    Returns the per-kW profile of each site, or the exception that fetching it raised.
+    """
+    cache = get_profile_cache()
+    local = threading.local()
+    lock = threading.Lock()
+    resume = 0.0  # no request starts before this time
+
+    def request(params: dict) -> dict:
+        nonlocal resume
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        for attempt in range(retries + 1):
+            with lock:
+                wait = resume - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            response = local.session.get(
+                PVWatts.PVWATTS_QUERY_URL,
+                params={**params, "radius": 0, "api_key": PVWatts.api_key},
+                timeout=timeout,
+            )
+            if response.status_code == 403:
+                raise RuntimeError("Forbidden, 403; check the PVWatts API key.")
+            try:
+                raw = response.json()
+            except ValueError:
+                raw = {}
+            if not _rate_limited(response, raw):
+                return raw
+            get_telemetry().count("rate_limited")
+            delay = _retry_after(response.headers.get("Retry-After"))
+            if delay is None:
+                delay = backoff * 2**attempt * random.uniform(1, 1.25)
+            with lock:
+                resume = max(resume, time.monotonic() + delay)
+        raise RateLimited(f"Still rate-limited after {retries} retries.")
+
+    def fetch(profile: PVWattsProfile) -> np.ndarray:
+        params = profile.params()
+        # as in `request_pvwatts`, so that `PVWattsProfile.reference` finds it
+        key = {"url": PVWatts.PVWATTS_QUERY_URL, **params}
+        with get_telemetry().span("pv_fetch"):
+            raw = cache.fetch(key, lambda: request(params))
+        if "outputs" not in raw:
+            raise RuntimeError(f"Failed to access PVWatts API. API response: {raw}")
+        return np.asarray(raw["outputs"]["ac"], dtype=np.float64)
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(fetch, p): p for p in dict.fromkeys(profiles)}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+    return results
+
+
+@dataclasses.dataclass(eq=False, frozen=True)
+class ArrayProfile(ProfileSource):
+    """A per-kW profile that is already in memory (or memory-mapped)."""
+
+    ac: np.ndarray
+
+    def per_kw(self) -> np.ndarray:
+        return self.ac
+
+
+@dataclasses.dataclass(frozen=True)
+class CSVProfile(ProfileSource):
+    """A column of a local hourly CSV, e.g. a PVWatts or TMY export.
+
+    The whole column is parsed at once by `np.loadtxt`.
+    `scale` converts the column to W per kW; e.g. `1 / system_capacity` for AC output (W)
+    of a known system, or `1 - losses` to use plane-of-array irradiance (W/m2)
+    as the output of a 1 kW array rated at 1000 W/m2.
+
+    Parameters
+    ----------
+    path
+        The CSV file.
+    column
+        A column name from the header row, or a column index.
+    header_row
+        The line number of the header row; data starts on the following line.
+    """
+
+    path: Union[str, os.PathLike]
+    column: Union[str, int] = "AC System Output (W)"
+    header_row: int = 0
+    delimiter: str = ","
+    scale: float = 1
+
+    def _usecol(self) -> int:
+        if isinstance(self.column, int):
+            return self.column
+        with open(self.path) as f:
+            for _ in range(self.header_row):
+                next(f)
+            header = [c.strip().strip('"') for c in next(f).split(self.delimiter)]
+        return header.index(self.column)
+
+    @functools.lru_cache
+    def per_kw(self) -> np.ndarray:
+        return self.scale * np.loadtxt(
+            self.path,
+            delimiter=self.delimiter,
+            skiprows=self.header_row + 1,
+            usecols=self._usecol(),
+            dtype=np.float64,
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class NpyProfile(ProfileSource):
+    """A row of a memory-mapped `.npy` file of shape (sites, hours), or the file itself if 1D.
+
+    See `save_profiles` for building such a file.
+    """
+
+    path: Union[str, os.PathLike]
+    site: Optional[int] = None
+
+    def per_kw(self) -> np.ndarray:
+        arr = np.load(self.path, mmap_mode="r")
+        return arr if self.site is None else arr[self.site]
+
+
+def save_profiles(
+    sources: Iterable[ProfileSource], path: Union[str, os.PathLike]
+) -> np.ndarray:
+    """Write the per-kW profiles of several sites, e.g. `CSVProfile`s, to one `.npy` file
+    for use with `NpyProfile`.
+
+    All sources must have the same number of hours.
+    """
+    sources = list(sources)
+    if not sources:
+        raise ValueError("No profiles to save.")
+    ac = sources[0].per_kw()
+    out = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float64, shape=(len(sources), ac.size)
+    )
+    out[0] = ac
+    for i, source in enumerate(sources[1:], 1):
+        out[i] = source.per_kw()
+    out.flush()
+    return out
+
+
+_default_profile: ProfileSource = PVWattsProfile()
+
+
+def get_default_profile() -> ProfileSource:
+    """The profile used by `Sun` when none is given."""
+    return _default_profile
+
+
+def set_default_profile(profile: ProfileSource):
+    global _default_profile
+    _default_profile = profile
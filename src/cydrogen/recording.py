@@ -0,0 +1,97 @@
+"""Policies for what `EnergySystem.simulate` keeps of the trajectory.
+
+The state at the start of every step is passed to a `Recorder` in blocks of shape
+(steps, *scenarios, nodes), so memory only scales with what the recorder keeps.
+"""
+import abc
+import os
+from typing import Optional, Sequence, Union
+import numpy as np
+
+
+class Recorder(abc.ABC):
+    def start(self, system, steps: int, shape: tuple) -> None:
+        """Called before simulating `steps` steps of states with the given shape."""
+
+    @abc.abstractmethod
+    def write(self, i: int, block: np.ndarray) -> None:
+        """Record the states of steps `i` to `i + len(block)`."""
+
+    def finish(self):
+        """Return what was recorded."""
+        return self
+
+
+def _node_indices(system, nodes: Sequence[Union[int, str]]) -> list:
+    names = system.g.inspect_ordering()
+    return [names.index(n) if isinstance(n, str) else n for n in nodes]
+
+
+class Trajectory(Recorder):
+    """Keep every state, optionally only of some nodes, at reduced precision or in a file.
+
+    Parameters
+    ----------
+    nodes
+        Node names or indices to keep; all nodes if None.
+    dtype
+        The storage precision, e.g. `np.float32`.
+    path
+        If given, write to a memory-mapped `.npy` file there instead of RAM.
+    """
+
+    def __init__(
+        self,
+        nodes: Optional[Sequence[Union[int, str]]] = None,
+        dtype=np.float64,
+        path: Optional[os.PathLike] = None,
+    ):
+        self.nodes = nodes
+        self.dtype = dtype
+        self.path = path
+
+    def start(self, system, steps, shape):
+        self._idx = (
+            slice(None) if self.nodes is None else _node_indices(system, self.nodes)
+        )
+        n = shape[-1] if self.nodes is None else len(self.nodes)
+        full_shape = (steps, *shape[:-1], n)
+        self.us = (
+            np.zeros(full_shape, dtype=self.dtype)
+            if self.path is None
+            else np.lib.format.open_memmap(
+                self.path, mode="w+", dtype=self.dtype, shape=full_shape
+            )
+        )
+
+    def write(self, i, block):
+        self.us[i : i + len(block)] = block[..., self._idx]
+
+    def finish(self):
+        if isinstance(self.us, np.memmap):
+            self.us.flush()
+        return self.us
+
+
+class FinalState(Recorder):
+    """Keep only the last state."""
+
+    def write(self, i, block):
+        self.final = block[-1]
+
+    def finish(self):
+        return self.final
+
+
+class Aggregates(Recorder):
+    """Keep the running sum, minimum and maximum of each node's state over time."""
+
+    def start(self, system, steps, shape):
+        self.sum = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def write(self, i, block):
+        self.sum += block.sum(axis=0)
+        np.fmin(self.min, block.min(axis=0), out=self.min)
+        np.fmax(self.max, block.max(axis=0), out=self.max)
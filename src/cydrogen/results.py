@@ -0,0 +1,226 @@
+"""A store of simulation results on disk, for post-processing many runs without re-simulating.
+
+Each run is a directory holding its trajectory node-major, as one `.npy` column per node that
+is memory-mapped on read, so only the columns used are loaded. A `.json` sidecar holds the node
+names, classes and spends, the final state and the total input. An SQLite index maps the
+parameters of each run to its directory.
+
+Example
+-------
+```py
+store = ResultsStore("results")
+s = basic_system(*spends)
+s.simulate()
+store.save(s, {"spends": spends, "site": "Larnaca"})
+...
+for run in store.runs(site="Larnaca"):
+    print(run.params, run.net_efficiency, run.column("OUTPUT")[-1])
+```
+"""
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+from typing import Iterator, Optional, Union
+import numpy as np
+from .cache import _SQLite, _to_json
+from .system import EnergySystem
+
+
+class SavedRun:
+    """A run reopened from a `ResultsStore`, post-processed like the `EnergySystem` it came from.
+
+    Attributes
+    ----------
+    params
+        The parameters it was saved under.
+    names, classes
+        The name and class name of each node.
+    purchased
+        The spend on each node (EUR), or None for nodes that are not bought.
+    spends
+        The spends it was saved with, if any, e.g. of a stack of systems.
+    final
+        The last state, of shape (*scenarios, nodes).
+    """
+
+    def __init__(self, path: os.PathLike):
+        self.path = pathlib.Path(path)
+        meta = json.loads((self.path / "meta.json").read_text())
+        self.params = meta["params"]
+        self.names = meta["names"]
+        self.classes = meta["classes"]
+        self.purchased = meta["purchased"]
+        self.spends = None if meta["spends"] is None else np.asarray(meta["spends"])
+        self.dt = meta["dt"]
+        self.steps = meta["steps"]
+        self.has_trajectory = meta["trajectory"]
+        self.final = np.asarray(meta["final"])
+        self._input_total = np.asarray(meta["input_total"])
+        self._columns = {}
+
+    def column(self, node: Union[int, str]) -> np.ndarray:
+        """The trajectory of one node, of shape (steps, *scenarios), memory-mapped."""
+        j = self.names.index(node) if isinstance(node, str) else node
+        if not self.has_trajectory:
+            raise ValueError("This run was saved without its trajectory.")
+        if j not in self._columns:
+            self._columns[j] = np.load(self.path / f"{j}.npy", mmap_mode="r")
+        return self._columns[j]
+
+    @property
+    def us(self) -> np.ndarray:
+        """The whole trajectory, of shape (steps, *scenarios, nodes), loaded into memory."""
+        return np.stack([self.column(j) for j in range(len(self.names))], axis=-1)
+
+    def plot(self, ax, exclude_cls_or_names=None):
+        """As `EnergySystem.plot`, loading only the columns plotted."""
+        exclude = {
+            c if isinstance(c, str) else c.__name__ for c in exclude_cls_or_names or ()
+        }
+        for j, (name, cls) in enumerate(zip(self.names, self.classes)):
+            if cls not in exclude and name not in exclude:
+                ax.plot(self.column(j), label=name)
+        ax.set_xlabel("Time (hours)")
+        ax.set_ylabel("Energy (J)")
+        ax.legend()
+
+    @property
+    def total_useful(self):
+        return self.final[..., self.names.index("OUTPUT")]
+
+    @property
+    def total_input(self):
+        return self._input_total
+
+    @property
+    def net_efficiency(self):
+        return self.total_useful / self.total_input
+
+    @property
+    def total_lost(self):
+        return self.final[..., self.names.index("LOST")]
+
+
+class ResultsStore(_SQLite):
+    """A directory of saved runs, indexed by their parameters.
+
+    Parameters are a JSON-serialisable dict, e.g. of the spends and the site;
+    NumPy arrays and scalars are saved as lists and numbers, and anything else raises `TypeError`.
+    A run is only listed once its row is in the index, which is written after its directory.
+    """
+
+    SCHEMA = "runs (key TEXT PRIMARY KEY, params TEXT)"
+
+    def __init__(self, directory: os.PathLike):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, params: dict) -> str:
+        blob = json.dumps(params, sort_keys=True, default=_to_json)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _database(self) -> os.PathLike:
+        return self.directory / "index.sqlite"
+
+    def _path(self, key: str) -> Optional[pathlib.Path]:
+        """The directory of the run indexed under `key`, or None if there is none.
+
+        A save interrupted after moving the old run aside leaves it at `{key}.old`.
+        """
+        db = self._connect()
+        if db.execute("SELECT 1 FROM runs WHERE key = ?", (key,)).fetchone() is None:
+            return None
+        for path in (self.directory / key, self.directory / f"{key}.old"):
+            if (path / "meta.json").exists():
+                return path
+        return None
+
+    def save(
+        self,
+        system: EnergySystem,
+        params: dict,
+        spends: Optional[np.ndarray] = None,
+        dtype=np.float64,
+    ) -> SavedRun:
+        """Save the last `simulate` of `system` under `params`, replacing any run saved under them.
+
+        The trajectory is saved if `system.us` was kept, at the precision `dtype`;
+        otherwise only the final state and the totals are.
+        """
+        key = self.key(params)
+        path = self.directory / key
+        tmp = self.directory / f"{key}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        us = system.__dict__.get("us")
+        if us is not None:
+            for j in range(us.shape[-1]):
+                np.save(tmp / f"{j}.npy", np.ascontiguousarray(us[..., j], dtype=dtype))
+        nodes = system.g.nodes
+        params = json.loads(json.dumps(params, sort_keys=True, default=_to_json))
+        meta = {
+            "params": params,
+            "names": system.g.inspect_ordering(),
+            "classes": [type(n).__name__ for n in nodes],
+            "purchased": [getattr(n, "purchased", None) for n in nodes],
+            "spends": None if spends is None else np.asarray(spends).tolist(),
+            "dt": system.dt,
+            "steps": system.steps,
+            "trajectory": us is not None,
+            "final": np.asarray(system.final).tolist(),
+            "input_total": np.asarray(system.total_input).tolist(),
+        }
+        (tmp / "meta.json").write_text(json.dumps(meta))
+        # move the old run aside rather than deleting it, so that it survives until replaced
+        old = self.directory / f"{key}.old"
+        if path.exists():
+            shutil.rmtree(old, ignore_errors=True)
+            os.replace(path, old)
+        os.replace(tmp, path)
+        self._connect().execute(
+            "INSERT OR REPLACE INTO runs VALUES (?, ?)",
+            (key, json.dumps(params, sort_keys=True)),
+        )
+        shutil.rmtree(old, ignore_errors=True)
+        return SavedRun(path)
+
+    def load(self, params: dict) -> SavedRun:
+        """The run saved under `params`; raises `KeyError` if there is none."""
+        path = self._path(self.key(params))
+        if path is None:
+            raise KeyError(params)
+        return SavedRun(path)
+
+    def __contains__(self, params: dict) -> bool:
+        return self._path(self.key(params)) is not None
+
+    def __len__(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def find(self, **where) -> list:
+        """The parameters of all runs whose parameters include `where`, e.g. `find(site="Larnaca")`.
+
+        Only top-level parameters with scalar values can be matched.
+        """
+        sql = "SELECT params FROM runs"
+        if where:
+            sql += " WHERE " + " AND ".join(
+                "json_extract(params, ?) = ?" for _ in where
+            )
+        args = []
+        for k, v in where.items():
+            args += [f'$."{k}"', v.item() if isinstance(v, np.generic) else v]
+        return [json.loads(p) for (p,) in self._connect().execute(sql, args)]
+
+    def runs(self, **where) -> Iterator[SavedRun]:
+        """The runs whose parameters include `where`; see `find`."""
+        for params in self.find(**where):
+            yield self.load(params)
+
+    def delete(self, params: dict) -> None:
+        key = self.key(params)
+        self._connect().execute("DELETE FROM runs WHERE key = ?", (key,))
+        for path in (key, f"{key}.old"):
+            shutil.rmtree(self.directory / path, ignore_errors=True)
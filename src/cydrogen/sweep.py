@@ -0,0 +1,169 @@
+"""Restartable sweeps of independent optimisations, e.g. over the number of HEVs to supply.
+
+Each finished point is checkpointed to its own JSON file as soon as it is solved,
+so a sweep interrupted by a crash or by PVWatts rate-limiting resumes where it stopped.
+"""
+import concurrent.futures
+import json
+import os
+import pathlib
+import warnings
+from typing import Callable, Dict, Hashable, Iterable, Optional
+import numpy as np
+import scipy.optimize
+from .cache import EvaluationCache, _to_json
+from .optimise import MinimiseHEVBudget, Optimiser
+from .profiles import get_default_profile, set_default_profile
+from .units import YEARLY_HYUNDAI_NEXO_ENERGY_CONSUMPTION
+
+# PV, battery, electrolyser and hydrogen storage budgets per HEV (EUR), near the optimum for one HEV
+HEV_X0 = np.array([7.5e3, 7.5e3, 1.875e4, 3.75e4])
+
+
+def solve_hev(
+    num_hevs: float,
+    x0: Optional[np.ndarray] = None,
+    options: Optional[dict] = None,
+    cache: Optional[EvaluationCache] = None,
+) -> scipy.optimize.OptimizeResult:
+    """Minimise the budget of `basic_system` that supplies `num_hevs` Hyundai Nexos for a year."""
+    opt = MinimiseHEVBudget(
+        {
+            "x0": HEV_X0 * num_hevs if x0 is None else np.asarray(x0),
+            "bounds": [(3500, 3000e6)] + [(0, None)] * 3,  # PV has limits
+            "method": "L-BFGS-B",
+            "jac": "2-point",
+            **(options or {}),
+        },
+        cache=cache,
+    )
+    opt.output_limit = YEARLY_HYUNDAI_NEXO_ENERGY_CONSUMPTION * num_hevs
+    return opt()
+
+
+def scaled_neighbour(
+    point: float, done: Dict[float, scipy.optimize.OptimizeResult]
+) -> Optional[np.ndarray]:
+    """Seed from the nearest solved point (on a log scale), with budgets scaled in proportion."""
+    solved = [p for p, r in done.items() if r.success]
+    if not solved:
+        return None
+    nearest = min(solved, key=lambda p: abs(np.log(point / p)))
+    return np.asarray(done[nearest].x) * (point / nearest)
+
+
+def solved(result: scipy.optimize.OptimizeResult) -> bool:
+    """Whether `result` succeeded with a finite value other than the `BAD_VALUE` penalty."""
+    fun = np.asarray(result.get("fun", np.nan), dtype=float)
+    return bool(
+        result.get("success", False)
+        and np.isfinite(fun).all()
+        and (fun < Optimiser.BAD_VALUE).all()
+    )
+
+
+def save_result(path: os.PathLike, point, result: scipy.optimize.OptimizeResult):
+    """Write the JSON-representable fields of `result` (e.g. not `hess_inv`) atomically."""
+    fields = {}
+    for k, v in result.items():
+        try:
+            json.dumps(v, default=_to_json)
+        except TypeError:
+            continue
+        fields[k] = v
+    tmp = pathlib.Path(f"{path}.tmp")
+    tmp.write_text(json.dumps({"point": point, "result": fields}, default=_to_json))
+    os.replace(tmp, path)
+
+
+def load_result(path: os.PathLike) -> tuple:
+    """Return the point and result saved by `save_result`."""
+    data = json.loads(pathlib.Path(path).read_text())
+    result = scipy.optimize.OptimizeResult(data["result"])
+    if "x" in result:
+        result.x = np.asarray(result.x)
+    return data["point"], result
+
+
+def run_sweep(
+    points: Iterable[Hashable],
+    directory: os.PathLike,
+    solve: Callable[..., scipy.optimize.OptimizeResult] = solve_hev,
+    workers: Optional[int] = None,
+    seed: Optional[Callable] = scaled_neighbour,
+) -> Dict[Hashable, scipy.optimize.OptimizeResult]:
+    """Solve `solve(point, x0)` for every point not yet checkpointed in `directory`.
+
+    Parameters
+    ----------
+    points
+        The sweep points, e.g. numbers of HEVs; they must be JSON-serialisable.
+    solve
+        A picklable function of the point and the initial guess (None for its default),
+        e.g. `functools.partial(solve_hev, cache=EvaluationCache(path=...))`.
+    workers
+        Solve this many points at once in a process pool; serially in this process if None.
+    seed
+        A function of the point and the results so far returning `x0`, or None for the default.
+        Each point is seeded when it is started, so in a pool only from points finished by then.
+
+    Returns
+    -------
+    The results of all checkpointed points, including those from earlier runs.
+    Only `solved` points are checkpointed; points whose `solve` raised or did not succeed
+    are warned about and left out, so that rerunning retries them.
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    done = dict(load_result(p) for p in directory.glob("point-*.json"))
+    # JSON turns tuples into lists; failures checkpointed by earlier versions are retried
+    done = {
+        tuple(p) if isinstance(p, list) else p: r for p, r in done.items() if solved(r)
+    }
+    pending = [p for p in points if p not in done]
+
+    def x0(point):
+        return None if seed is None else seed(point, done)
+
+    def finish(point, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            warnings.warn(f"Sweep point {point!r} failed with {e!r}; rerun to retry.")
+            return
+        if not solved(result):
+            warnings.warn(
+                f"Sweep point {point!r} was not solved ({result.get('message')!r}); "
+                "rerun to retry."
+            )
+            return
+        save_result(directory / f"point-{point}.json", point, result)
+        done[point] = result
+
+    if workers is None:
+        for point in pending:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(solve(point, x0(point)))
+            except Exception as e:
+                future.set_exception(e)
+            finish(point, future)
+        return done
+
+    # workers started by "spawn" or "forkserver" do not inherit the default profile
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=set_default_profile, initargs=(get_default_profile(),)
+    ) as pool:
+        running = {}
+        pending.reverse()
+        while pending or running:
+            # keep the pool busy, starting each point with the latest seeds
+            while pending and len(running) < workers:
+                point = pending.pop()
+                running[pool.submit(solve, point, x0(point))] = point
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                finish(running.pop(future), future)
+    return done
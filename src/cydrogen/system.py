@@ -1,6 +1,10 @@
+import itertools
+from typing import Callable, Iterable, Iterator, Optional, Sequence, Tuple, Union
 import numpy as np
-from .graph import Graph
-from .units import HOUR, WH, HOURS_PER_YEAR
+from .graph import Edge, Graph, Node
+from .recording import Recorder, Trajectory
+from .telemetry import get_telemetry
+from .units import HOUR, KILO, WH, HOURS_PER_YEAR
 from .model import (
     BatteryConnectionToElectrolyserCompressorProcess,
     EnergyStore,
@@ -13,60 +17,732 @@ from .model import (
 )
 
 
+def resample_inputs(inputs: np.ndarray, dt_in: float, dt_out: float) -> np.ndarray:
+    """Convert energy per step of `dt_in` seconds (along the first axis) into energy per step of `dt_out`.
+
+    Power is taken as constant within each input step, so the cumulative energy is
+    interpolated linearly at the new step boundaries and the total is conserved.
+    A trailing partial step is dropped.
+    """
+    inputs = np.asarray(inputs, dtype=np.float64)
+    if dt_in == dt_out:
+        return inputs
+    cumulative = np.concatenate(
+        [np.zeros((1, *inputs.shape[1:])), np.cumsum(inputs, axis=0)]
+    )
+    steps = int(len(inputs) * dt_in / dt_out * (1 + 1e-12))
+    pos = np.arange(steps + 1) * (dt_out / dt_in)
+    i = np.minimum(pos.astype(int), len(inputs) - 1)
+    frac = (pos - i).reshape(-1, *(1,) * (inputs.ndim - 1))
+    at = cumulative[i] + frac * (cumulative[i + 1] - cumulative[i])
+    return np.diff(at, axis=0)
+
+
+def _zero_run_lengths(rows: np.ndarray) -> np.ndarray:
+    """The number of consecutive all-zero rows starting at each row."""
+    n = len(rows)
+    nonzero = np.flatnonzero(rows.any(axis=tuple(range(1, rows.ndim))))
+    following = np.full(n + 1, n)
+    following[nonzero] = nonzero
+    return np.minimum.accumulate(following[::-1])[::-1][:n] - np.arange(n)
+
+
+def _flat_windows(
+    rows: np.ndarray, weights: np.ndarray, rtol: float, lengths: np.ndarray
+) -> np.ndarray:
+    """Whether each run of `lengths` rows starting at each row may be replaced by its mean.
+
+    Half the length times the total variation of a run bounds its absolute deviation from the mean,
+    which is weighted by `weights` (per input) and must be at most `rtol` times its total.
+    Returns an array of shape (len(lengths), rows), False where a run would pass the last row.
+    """
+    n = len(rows)
+    varied = (np.abs(np.diff(rows, axis=0)) * weights).sum(axis=-1)
+    variation = np.concatenate(
+        [np.zeros((1, *varied.shape[1:])), np.cumsum(varied, axis=0)]
+    )
+    total = np.concatenate(
+        [np.zeros((1, *varied.shape[1:])), np.cumsum(rows.sum(axis=-1), axis=0)]
+    )
+    flat = np.zeros((len(lengths), n), dtype=bool)
+    for c, length in enumerate(lengths):
+        if length > n:
+            break
+        m = n - length + 1
+        ok = length / 2 * (variation[length - 1 :] - variation[:m]) <= rtol * (
+            total[length:] - total[:m]
+        )
+        flat[c, :m] = ok.reshape(m, -1).all(axis=-1)
+    return flat
+
+
 # NOTE: currently assumes user has constructed the graph using dummy processes as necessary
 # the need for dummy processes is analogous to critical path analysis.
 class EnergySystem:
-    def __init__(self, g: Graph, dt=HOUR) -> None:
+    """Discrete-time simulation of energy flowing through a graph of stores and processes.
+
+    All state arrays may carry leading axes for independent scenarios,
+    e.g. `U_max` of shape (scenarios, nodes) and `weighted_A` of shape (scenarios, nodes, nodes),
+    which are then stepped together in a single time loop; see `EnergySystem.stack`.
+
+    Flows are computed either from dense (nodes, nodes) matrices or from edge lists.
+    By default the edge-list ("sparse") kernel is used for large graphs with few edges.
+    The kernel is set up from the arrays at construction; call `set_kernel` after modifying them.
+
+    Each step lasts `dt` seconds (an hour by default). Hourly PV output is resampled to it,
+    and flow fractions and losses are rescaled; see `with_timestep`. With `simulate(rtol=...)`,
+    spans of flat input are stepped over at once, within an error tolerance; see `iter_simulate`.
+    """
+
+    SPARSE_MIN_NODES = 32
+    SPARSE_MAX_DENSITY = 0.1
+    # see `iter_simulate`; the closed form costs O(nodes^3) per doubling
+    FAST_FORWARD_MIN_STEPS = 4
+    FAST_FORWARD_MAX_NODES = 64
+    # the stores and processes bought by each spend; see `sensitivity`
+    spend_groups: Optional[Sequence[Sequence[Union[Node, Edge]]]] = None
+
+    def __init__(self, g: Graph, dt=HOUR, kernel=None) -> None:
         self.g = g
-        self.dt = dt
-        self.U_max = np.array(g.node_apply(lambda n: n.max_energy_stored))
-        self.U_frac_dt_loss = dt * np.array(
-            g.node_apply(lambda n: n.static_frac_power_loss)
+        self.dt = HOUR
+        c = g.compile()
+        self.U_0 = c.node_column("value").astype(np.float64)
+        self.U_max = np.array(c.node_column("max_energy_stored"))
+        self.U_frac_dt_loss = HOUR * c.node_column("static_frac_power_loss")
+        self.A = c.adjacency()
+        # edge weights are the fractions of the source's energy sent per hour
+        self.weighted_A = c.adjacency(
+            c.edge_column("weight") * c.edge_column("efficiency")
+        )
+        self.process_power_limits = c.adjacency(c.edge_column("max_power_transfer"))
+        # Assumes AC from PV is the only input; its energy per step overwrites the node's state.
+        self.input_nodes = tuple(
+            i for i, n in enumerate(c.nodes) if n.__dict__.get("outputs")
         )
-        self.A = g.get_adjacency_matrix()
-        self.weighted_A = g.get_adjacency_matrix(lambda e: e.weight * e.efficiency)
-        self.process_power_limits = g.get_adjacency_matrix(
-            lambda e: e.max_power_transfer
+        self.inputs = (
+            np.stack(
+                [np.asarray(c.nodes[j].data.outputs["ac"]) for j in self.input_nodes],
+                axis=-1,
+            )
+            * WH
+            if self.input_nodes
+            else np.zeros((HOURS_PER_YEAR, 0))
         )
+        if dt != HOUR:
+            self._set_timestep(dt)
+        self.set_kernel(kernel)
         # print(f"U_max:\n{self.U_max}")
         # print(f"U_frac_dt_loss:\n{self.U_frac_dt_loss}")
         # print(f"A:\n{self.A}")
         # print(f"weighted_A:\n{self.weighted_A}")
         # print(f"process_power_limits:\n{self.process_power_limits}")
 
+    @classmethod
+    def from_arrays(
+        cls,
+        g: Graph,
+        U_0: np.ndarray,
+        U_max: np.ndarray,
+        U_frac_dt_loss: np.ndarray,
+        weighted_A: np.ndarray,
+        process_power_limits: np.ndarray,
+        input_nodes: tuple,
+        inputs: np.ndarray,
+        dt=HOUR,
+        kernel=None,
+    ) -> "EnergySystem":
+        """Build a system directly from its arrays; `g` only provides the node metadata.
+
+        `inputs` has shape (steps, *scenarios, len(input_nodes)).
+        """
+        self = cls.__new__(cls)
+        self.g = g
+        self.dt = dt
+        self.U_0 = np.asarray(U_0, dtype=np.float64)
+        self.U_max = np.asarray(U_max)
+        self.U_frac_dt_loss = np.asarray(U_frac_dt_loss)
+        self.weighted_A = np.asarray(weighted_A)
+        self.A = (self.weighted_A != 0).astype(np.float64)
+        self.process_power_limits = np.asarray(process_power_limits)
+        self.input_nodes = tuple(input_nodes)
+        self.inputs = np.asarray(inputs)
+        self.set_kernel(kernel)
+        return self
+
+    @classmethod
+    def stack(cls, systems) -> "EnergySystem":
+        """Stack systems with the same topology into one, with scenarios along the first axis.
+
+        Nodes are matched by name, since graph traversal order may differ between systems.
+        The node metadata (`g`) of the first system is kept.
+        """
+        systems = list(systems)
+        names = systems[0].g.inspect_ordering()
+        if len(set(names)) != len(names):
+            raise ValueError(f"Cannot match nodes with duplicate names: {names}")
+        arrays = {
+            k: []
+            for k in (
+                "U_0",
+                "U_max",
+                "U_frac_dt_loss",
+                "weighted_A",
+                "process_power_limits",
+            )
+        }
+        ref_inputs = systems[0].input_nodes
+        inputs = []
+        for s in systems:
+            try:
+                order = [s.g.inspect_ordering().index(n) for n in names]
+            except ValueError as e:
+                raise ValueError("Cannot stack systems with different nodes.") from e
+            if len(order) != len(s.g.nodes) or sorted(
+                order.index(j) for j in s.input_nodes
+            ) != list(ref_inputs):
+                raise ValueError("Cannot stack systems with different nodes.")
+            for k in ("U_0", "U_max", "U_frac_dt_loss"):
+                arrays[k].append(getattr(s, k)[order])
+            for k in ("weighted_A", "process_power_limits"):
+                arrays[k].append(getattr(s, k)[np.ix_(order, order)])
+            inputs.append(
+                s.inputs[:, [s.input_nodes.index(order[j]) for j in ref_inputs]]
+            )
+        return cls.from_arrays(
+            systems[0].g,
+            **{k: np.stack(v) for k, v in arrays.items()},
+            input_nodes=ref_inputs,
+            inputs=np.stack(inputs, axis=1),
+            dt=systems[0].dt,
+            kernel=systems[0].kernel,
+        )
+
     @staticmethod
     def _dU(A: np.ndarray, U: np.ndarray, P: np.ndarray, dt) -> np.ndarray:
-        """C.f. the tests for a naive impl."""
-        return -np.sum(np.fmin(A * U[:, None], dt * P), axis=1) + np.sum(
-            np.fmin(A.T * U[None, :], dt * P.T), axis=1
-        )
+        """C.f. the tests for a naive impl.
 
-    def update_state(self, U) -> np.ndarray:
-        return np.fmin(
-            (
-                U
-                + EnergySystem._dU(
-                    self.weighted_A, U, self.process_power_limits, self.dt
-                )
+        Leading axes are broadcast as independent scenarios.
+        """
+        flows = np.fmin(A * U[..., :, None], dt * P)
+        return flows.sum(axis=-2) - flows.sum(axis=-1)
+
+    @staticmethod
+    def _dU_sparse(
+        src: np.ndarray,
+        dst: np.ndarray,
+        a: np.ndarray,
+        U: np.ndarray,
+        p: np.ndarray,
+        dt,
+    ) -> np.ndarray:
+        """Like `_dU`, but with `a` and `p` holding the entries of `A` and `P` at each (src, dst) edge."""
+        flows = np.fmin(a * U[..., src], dt * p)
+        n = U.shape[-1]
+        if flows.ndim == 1:
+            return np.bincount(dst, flows, n) - np.bincount(src, flows, n)
+        # scatter every scenario at once by offsetting its node indices
+        lead = flows.shape[:-1]
+        offsets = n * np.arange(np.prod(lead)).reshape(*lead, 1)
+        size = offsets.size * n
+        return (
+            np.bincount((dst + offsets).ravel(), flows.ravel(), size)
+            - np.bincount((src + offsets).ravel(), flows.ravel(), size)
+        ).reshape(*lead, n)
+
+    def set_kernel(self, kernel=None):
+        """Choose the "dense" or "sparse" flow kernel, or pick by graph size and density if None."""
+        n = self.weighted_A.shape[-1]
+        structure = self.weighted_A != 0
+        src, dst = np.nonzero(structure.reshape(-1, n, n).any(axis=0))
+        if kernel is None:
+            kernel = (
+                "sparse"
+                if n >= self.SPARSE_MIN_NODES
+                and src.size <= self.SPARSE_MAX_DENSITY * n * n
+                else "dense"
+            )
+        if kernel not in ("dense", "sparse"):
+            raise ValueError(f"Unknown kernel {kernel!r}.")
+        self.kernel = kernel
+        self._src, self._dst = src, dst
+        self._a = self.weighted_A[..., src, dst]
+        self._p = self.process_power_limits[..., src, dst]
+        # flows (edges) to the change of each store (nodes), for `_fast_forward`
+        self._incidence = np.zeros((n, src.size))
+        self._incidence[dst, np.arange(src.size)] += 1
+        self._incidence[src, np.arange(src.size)] -= 1
+
+    def dU(self, U) -> np.ndarray:
+        if self.kernel == "sparse":
+            return EnergySystem._dU_sparse(
+                self._src, self._dst, self._a, U, self._p, self.dt
             )
-            * (1 - self.U_frac_dt_loss),
+        return EnergySystem._dU(self.weighted_A, U, self.process_power_limits, self.dt)
+
+    def update_state(self, U) -> np.ndarray:
+        return np.fmin((U + self.dU(U)) * (1 - self.U_frac_dt_loss), self.U_max)
+
+    def _step_fractions(self, factor: float) -> Tuple[np.ndarray, np.ndarray]:
+        """The factor on each node's row of `weighted_A` and its loss fraction, for a step of `factor * dt`.
+
+        A store whose rows sum to `r` keeps `1 - r` of its energy per step, so `(1 - r)^factor`
+        over the longer or shorter step: fractions compound, and stay within [0, 1] for any step.
+        Rows summing to more than 1 are capped at 1. Input nodes' rows are fractions of the
+        energy produced within the step, so are unchanged.
+        """
+        if factor == 1:
+            return np.ones(self.U_max.shape), self.U_frac_dt_loss
+        out = self.weighted_A.sum(axis=-1)
+        sent = 1 - np.clip(1 - out, 0, None) ** factor
+        scale = np.where(out > 0, sent / np.where(out > 0, out, 1), 1)
+        scale[..., list(self.input_nodes)] = 1
+        loss = 1 - np.clip(1 - self.U_frac_dt_loss, 0, None) ** factor
+        return scale, loss
+
+    def _set_timestep(self, dt):
+        factor = dt / self.dt
+        scale, self.U_frac_dt_loss = self._step_fractions(factor)
+        self.weighted_A = self.weighted_A * scale[..., None]
+        self.inputs = resample_inputs(self.inputs, self.dt, dt)
+        self.dt = dt
+
+    def with_timestep(self, dt) -> "EnergySystem":
+        """The same system stepped every `dt` seconds, e.g. `15 * MINUTE`, with its inputs resampled.
+
+        Flow fractions and losses are rescaled by `_step_fractions`, and power limits apply per second.
+        """
+        s = EnergySystem.from_arrays(
+            self.g,
+            self.U_0,
             self.U_max,
+            self.U_frac_dt_loss,
+            self.weighted_A,
+            self.process_power_limits,
+            self.input_nodes,
+            self.inputs,
+            self.dt,
+            self.kernel,
         )
+        s.spend_groups = self.spend_groups
+        s._set_timestep(dt)
+        s.set_kernel(self.kernel)
+        return s
+
+    def _steps(self, steps: Optional[int]) -> int:
+        """`steps`, or the number of steps in a year if None."""
+        return round(HOURS_PER_YEAR * HOUR / self.dt) if steps is None else steps
+
+    def _regime(self, U):
+        """Which flows are below their power limit and which stores fill up in a step from `U`."""
+        demand = self._a * U[..., self._src]
+        below = demand <= self.dt * self._p
+        flows = np.where(below, demand, self.dt * self._p)
+        v = (U + flows @ self._incidence.T) * (1 - self.U_frac_dt_loss)
+        return below, ~(v <= self.U_max)
+
+    def _fast_forward(
+        self, u: np.ndarray, steps: int, powers: dict, mean: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """The states at the start of up to `steps` steps without input following the state `u`.
+
+        While no flow crosses its power limit and no store fills up or stops being full,
+        a step is an affine map `M @ u + c`, so after `t` steps the state is `M^t @ u + G_t`
+        with `G_t = (I + M + ... + M^(t-1)) @ c`. These only depend on the regime, so they are
+        kept in `powers` for later spans in the same regime (e.g. the next night).
+        With a constant input `mean` per step, it adds `H_t @ mean`, where `H_t` is the sum of
+        the same powers of `M` restricted to the input nodes.
+        The states are returned up to the first whose step would take a different regime,
+        which the caller steps by `update_state`.
+        """
+        below, full = self._regime(u)
+        key = (below.tobytes(), full.tobytes())
+        if key not in powers or len(powers[key][0]) < steps:
+            powers[key] = self._affine_powers(below, full, steps)
+        Mt, G, H = powers[key]
+        states = (Mt[:steps] @ u[..., None])[..., 0] + G[:steps]
+        if mean is not None:
+            states += (H[:steps] @ mean[..., None])[..., 0]
+        b, f = self._regime(states[:-1])
+        same = (b == below).all(axis=-1) & (f == full).all(axis=-1)
+        changed = np.flatnonzero(~same.reshape(len(same), -1).all(axis=-1))
+        return states[: changed[0] + 1] if changed.size else states
+
+    def _affine_powers(
+        self, below, full, steps: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """`M^t`, `G_t` and `H_t` for t = 1..steps in the given regime; see `_fast_forward`."""
+        n = self.U_max.shape[-1]
+        keep = np.where(full, 0, 1 - self.U_frac_dt_loss)
+        # flows below their limit are proportional to their source; the rest are constant
+        rate = np.where(below, self._a, 0)[..., None] * np.eye(n)[self._src]
+        M = keep[..., :, None] * (np.eye(n) + self._incidence @ rate)
+        c = keep * (np.where(below, 0, self.dt * self._p) @ self._incidence.T)
+        c = np.where(full, self.U_max, c)
+        idx = list(self.input_nodes)
+        M[..., idx, :] = 0
+        c[..., idx] = 0
+        # by doubling: M^(k + j) = M^k @ M^j and G_(k + j) = G_k + M^k @ G_j, and likewise H
+        Mt = np.empty((steps, *M.shape))
+        G = np.empty((steps, *c.shape))
+        H = np.empty((steps, *M.shape[:-1], len(idx)))
+        Mt[0], G[0], H[0] = M, c, np.eye(n)[:, idx]
+        k = 1
+        while k < steps:
+            m = min(k, steps - k)
+            Mt[k : k + m] = Mt[k - 1] @ Mt[:m]
+            G[k : k + m] = G[k - 1] + (Mt[k - 1] @ G[:m, ..., None])[..., 0]
+            H[k : k + m] = H[k - 1] + Mt[k - 1] @ H[:m]
+            k += m
+        return Mt, G, H
+
+    def iter_simulate(
+        self,
+        inputs: Union[np.ndarray, Iterable[np.ndarray], None] = None,
+        steps: Optional[int] = None,
+        block: int = 7 * 24,
+        fast_forward: bool = False,
+        inputs_dt: Optional[float] = None,
+        rtol: Optional[float] = None,
+    ) -> Iterator[np.ndarray]:
+        """Simulate lazily, yielding the state at the start of each step in blocks.
+
+        Parameters
+        ----------
+        inputs
+            The energy per step of the input nodes, of shape (steps, *scenarios, inputs),
+            either as one (possibly memory-mapped) array or as an iterable of chunks of any length,
+            e.g. read from disk. Defaults to `self.inputs`.
+        steps
+            Stop after this many steps; otherwise run until `inputs` is exhausted.
+            Systems without input nodes run indefinitely.
+        block
+            The number of steps per yielded block of shape (block, *scenarios, nodes);
+            the last block may be shorter.
+        fast_forward
+            Jump over spans without input (e.g. nights) in closed form wherever no flow or store
+            changes between being limited and not; see `_fast_forward`. The states agree with
+            stepping every hour up to rounding (about 1e-12 relative), but are not bitwise equal.
+            Ignored for graphs of more than `FAST_FORWARD_MAX_NODES` nodes.
+        inputs_dt
+            The step of `inputs` (s) if it differs from `dt`, e.g. for minute-resolution PV;
+            they must then be an array, and are resampled by `resample_inputs`.
+        rtol
+            Step adaptively: as `fast_forward` (which it implies), but also over spans whose input
+            varies little, taking it as constant at its mean. A span is taken if the deviation of
+            its input from the mean, weighted by the fraction each input node sends on per step,
+            is at most `rtol` times its energy, so the states stay within about `rtol` times the
+            input energy of stepping every `dt` (in L1 over the nodes). Steps are thus coarsened
+            over flat input, e.g. nights or sub-hourly steps of hourly PV, and refined to single
+            steps wherever a flow reaches its power limit or a store fills up or runs empty.
+        """
+        if inputs is None:
+            inputs = self.inputs if self.input_nodes else None
+        if inputs is not None and inputs_dt is not None:
+            inputs = resample_inputs(inputs, inputs_dt, self.dt)
+        if inputs is None:
+            chunks = itertools.repeat(np.zeros((block, *self.U_max.shape[:-1], 0)))
+        elif isinstance(inputs, np.ndarray):
+            chunks = (inputs[i : i + block] for i in range(0, len(inputs), block))
+        else:
+            chunks = inputs
+        if steps is None:
+            steps = np.inf
+        u = np.broadcast_to(self.U_0, self.U_max.shape).copy()
+        idx = list(self.input_nodes)
+        out = np.empty((block, *u.shape))
+        fast_forward = fast_forward or rtol is not None
+        fast_forward = fast_forward and u.shape[-1] <= self.FAST_FORWARD_MAX_NODES
+        if fast_forward and rtol is not None:
+            # the span lengths tried (1 and 1.5 times powers of two), and the fraction of each
+            # input sent on per step
+            lengths = np.unique(
+                np.outer([2, 3], 2 ** np.arange(20)) * self.FAST_FORWARD_MIN_STEPS // 2
+            )
+            lengths = lengths[lengths < block]
+            weights = np.abs(self.weighted_A[..., idx, :]).sum(axis=-1)
+        powers = {}
+        i = k = 0
+        for chunk in chunks:
+            if fast_forward:
+                chunk = np.asarray(chunk)
+                quiet = _zero_run_lengths(chunk)
+                if rtol is not None:
+                    flat = _flat_windows(chunk, weights, rtol, lengths)
+                    longest = np.where(flat, lengths[:, None], 0).max(axis=0, initial=0)
+            skip = 0
+            for r, row in enumerate(chunk):
+                if skip:
+                    skip -= 1
+                    continue
+                if i == steps:
+                    break
+                u[..., idx] = row
+                out[k] = u
+                if fast_forward:
+                    # within this block, so that the states can be copied in one go
+                    room = min(steps - i, block - k) - 1
+                    n = min(quiet[r] - 1, room)
+                    mean = None
+                    if (
+                        rtol is not None
+                        and r + 1 < len(chunk)
+                        and longest[r + 1] > max(n, 0)
+                    ):
+                        fits = lengths[flat[:, r + 1] & (lengths <= room)]
+                        if fits.size and fits[-1] > n:
+                            n = fits[-1]
+                            mean = chunk[r + 1 : r + 1 + n].mean(axis=0)
+                    if n >= self.FAST_FORWARD_MIN_STEPS:
+                        ahead = self._fast_forward(u, n, powers, mean)
+                        skip = len(ahead)
+                        if mean is not None:
+                            ahead[..., idx] = chunk[r + 1 : r + 1 + skip]
+                        out[k + 1 : k + 1 + skip] = ahead
+                        u = ahead[-1]
+                        i += skip
+                        k += skip
+                u = self.update_state(u)
+                i += 1
+                k += 1
+                if k == block:
+                    yield out
+                    out = np.empty_like(out)
+                    k = 0
+            if i == steps:
+                break
+        if k:
+            yield out[:k]
+
+    def simulate(
+        self,
+        recorder: Optional[Recorder] = None,
+        steps: Optional[int] = None,
+        inputs: Union[np.ndarray, Iterable[np.ndarray], None] = None,
+        fast_forward: bool = False,
+        inputs_dt: Optional[float] = None,
+        rtol: Optional[float] = None,
+    ):
+        """Simulate `steps` steps (a year of steps of `dt` by default), passing each block of states to `recorder`.
+
+        By default the whole trajectory is kept as `self.us`, of shape (steps, *scenarios, nodes),
+        and returned; otherwise the recorder's result is returned.
+        The last state is always kept as `self.final`.
+        See `iter_simulate` for `inputs`, `fast_forward`, `inputs_dt` and adaptive steps within `rtol`.
+        """
+        steps = self._steps(steps)
+        if steps <= 0:
+            raise ValueError(f"Cannot simulate {steps} steps; there is no final state.")
+        if recorder is None:
+            recorder = Trajectory()
+        recorder.start(self, steps, self.U_max.shape)
+        i = 0
+        input_total = 0
+        with get_telemetry().span("time_loop", steps=steps):
+            for states in self.iter_simulate(
+                inputs, steps, fast_forward=fast_forward, inputs_dt=inputs_dt, rtol=rtol
+            ):
+                recorder.write(i, states)
+                input_total = input_total + states[..., list(self.input_nodes)].sum(
+                    axis=0
+                )
+                i += len(states)
+        if i < steps:
+            raise ValueError(f"Inputs ran out after {i} of {steps} steps.")
+        self.final = states[-1]
+        self.steps = steps
+        # input nodes are overwritten by their profile every step
+        self._input_total = np.sum(input_total, axis=-1)
+        result = recorder.finish()
+        if isinstance(recorder, Trajectory) and recorder.nodes is None:
+            self.us = result
+        else:
+            self.__dict__.pop("us", None)
+        return result
+
+    def simulate_until(
+        self,
+        stop: Callable[[int, np.ndarray], bool],
+        steps: Optional[int] = None,
+        inputs: Union[np.ndarray, Iterable[np.ndarray], None] = None,
+        check_every: int = 24,
+    ) -> Tuple[int, np.ndarray]:
+        """Simulate until `stop(i, u)` holds for the state `u` at the start of step `i`.
+
+        `stop` is checked every `check_every` steps and on the last step.
+        Runs for a year by default. Returns the step and state at which the simulation stopped,
+        without recording anything else.
+        """
+        steps = self._steps(steps)
+        i = -1
+        with get_telemetry().span("time_loop", steps=steps):
+            for states in self.iter_simulate(inputs, steps, check_every):
+                i += len(states)
+                u = states[-1]
+                if stop(i, u):
+                    break
+        return i, u
+
+    def reaches(
+        self,
+        target: float,
+        node: str = "OUTPUT",
+        steps: Optional[int] = None,
+        inputs: Optional[np.ndarray] = None,
+    ) -> Union[bool, np.ndarray]:
+        """Whether the final state of `node` exceeds `target`, stopping as soon as that is known.
+
+        Equivalent to `simulate(FinalState(), steps, inputs)[..., j] > target` for the node's index `j`.
+        Stopping early needs every flow towards the node to be non-negative, i.e. non-negative
+        fractions, power limits, capacities, inputs and initial states, and no node sending out
+        more than it holds; otherwise the whole run is simulated.
+        A "yes" is then known once the node exceeds `target` if it can never lose energy
+        (no outgoing edges or losses). A "no" is known once `target` exceeds an upper bound on
+        what the node can still receive: its remaining power-limited inflow, and all the energy
+        that can still reach it.
+        For stacked systems, an array of answers is returned once all are known.
+        """
+        steps = self._steps(steps)
+        j = self.g.inspect_ordering().index(node)
+        A, P = self.weighted_A, self.process_power_limits
+        inputs = (self.inputs if inputs is None else np.asarray(inputs))[:steps]
+        if len(inputs) < steps:
+            raise ValueError(f"Inputs ran out after {len(inputs)} of {steps} steps.")
 
-    def simulate(self):
-        """Assumes AC from PV is only input and was the node initialising the graph."""
-        u = np.array(self.g.node_apply(lambda n: n.value))
-        us = np.zeros((HOURS_PER_YEAR, *u.shape))
-        indep_vars = tuple(
-            i for i, n in enumerate(self.g.nodes) if n.__dict__.get("outputs")
+        max_inflow = self.dt * np.where(A[..., :, j] != 0, P[..., :, j], 0).sum(axis=-1)
+        # nodes that can reach `node` (any scenario); energy elsewhere can never arrive
+        structure = (A != 0).reshape(-1, *A.shape[-2:]).any(axis=0)
+        reach = np.zeros(A.shape[-1], dtype=bool)
+        reach[j] = True
+        while True:
+            grown = reach | structure[:, reach].any(axis=1)
+            if (grown == reach).all():
+                break
+            reach = grown
+        idx = list(self.input_nodes)
+        held = reach.copy()
+        held[idx] = False
+        conserving = (
+            (A >= 0).all()
+            and (P >= 0).all()
+            and (A[..., held, :].sum(axis=-1) <= 1).all()
+            and (self.U_frac_dt_loss >= 0).all()
+            and (self.U_frac_dt_loss <= 1).all()
+            and (self.U_max >= 0).all()
+            and (np.broadcast_to(self.U_0, self.U_max.shape)[..., held] >= 0).all()
+            and (inputs >= 0).all()
         )
-        for i in range(HOURS_PER_YEAR):
-            for j in indep_vars:
-                u[j] = self.g.nodes[j].data.outputs["ac"][i] * WH
-            us[i] = u
-            u = self.update_state(u)
-        self.us = us
-        return us
+        monotonic = (
+            conserving
+            & (self.U_frac_dt_loss[..., j] == 0)
+            & ~(A[..., j, :] != 0).any(axis=-1)
+            & (self.U_0[..., j] <= self.U_max[..., j])
+        )
+        if conserving:
+            # energy entering the reachable nodes from the inputs during steps i..steps-2
+            rate = np.where(reach, A[..., idx, :], 0).sum(axis=-1)
+            incoming = (inputs[:-1] * rate).sum(axis=-1)
+            remaining = np.cumsum(incoming[::-1], axis=0)[::-1]
+            remaining = np.concatenate([remaining, np.zeros((1, *incoming.shape[1:]))])
+
+        hit = miss = np.zeros(self.U_max.shape[:-1], dtype=bool)
+
+        def stop(i, u):
+            nonlocal hit, miss
+            if not conserving:
+                return False
+            hit = hit | (monotonic & (u[..., j] > target))
+            bound = np.fmin(
+                u[..., j] + (steps - 1 - i) * max_inflow, self.U_max[..., j]
+            )
+            bound = np.fmin(bound, np.where(held, u, 0).sum(axis=-1) + remaining[i])
+            # allow for rounding in the bound itself
+            miss = miss | (bound * (1 + 1e-9) <= target)
+            return bool((hit | miss).all())
+
+        i, u = self.simulate_until(stop, steps, inputs)
+        answer = hit | (~miss & (u[..., j] > target))
+        return answer if answer.ndim else bool(answer)
+
+    def sensitivity(
+        self,
+        spend_groups: Optional[Sequence[Sequence[Union[Node, Edge]]]] = None,
+        steps: Optional[int] = None,
+    ) -> np.ndarray:
+        """Simulate `steps` steps (a year by default), returning the derivative of the final state
+        with respect to each spend.
+
+        Each group holds the stores (nodes) and processes (edges) whose `purchased` is one spend,
+        e.g. `pv_spend` buys both the `Sun` and its process; defaults to `self.spend_groups`.
+        Capacities and power limits are affine in `purchased` and PV output is proportional to
+        the nameplate capacity, while each step is a composition of `fmin`s. So tangents are
+        carried forward through the branch each `fmin` takes, in the same pass as the states.
+        This is exact wherever no flow or store is exactly at its limit, and one-sided where one is.
+
+        Returns an array of shape (nodes, groups); the final state is kept as `self.final`.
+        Stacked systems are not supported.
+        """
+        if self.U_max.ndim > 1:
+            raise ValueError("Sensitivities of stacked systems are not supported.")
+        groups = self.spend_groups if spend_groups is None else spend_groups
+        if groups is None:
+            raise ValueError("No spend groups given.")
+        steps = self._steps(steps)
+        if len(self.inputs) < steps:
+            raise ValueError(
+                f"Inputs ran out after {len(self.inputs)} of {steps} steps."
+            )
+        c = self.g.compile()
+        n, K = self.U_max.shape[-1], len(groups)
+        src, dst, a, p = self._src, self._dst, self._a, self._p
+        E = len(src)
+        edge_pos = {
+            (i, j): e for e, (i, j) in enumerate(zip(src.tolist(), dst.tolist()))
+        }
+        idx = list(self.input_nodes)
+
+        # derivatives of the capacities, power limits and inputs per unit of each spend
+        dU_max = np.zeros((n, K))
+        dp = np.zeros((E, K))
+        input_slope = np.zeros((len(idx), K))
+        for k, group in enumerate(groups):
+            for item in group:
+                if isinstance(item, Edge):
+                    e = edge_pos[c.index[item.node_from], c.index[item.node_to]]
+                    dp[e, k] += 1 / item.specific_power_cost
+                elif c.index[item] in self.input_nodes:
+                    # output is proportional to purchased - installation_cost
+                    input_slope[self.input_nodes.index(c.index[item]), k] += 1 / (
+                        item.purchased - item.installation_cost
+                    )
+                else:
+                    dU_max[c.index[item], k] += 1 / item.specific_energy_cost
+        # flows leave their source and arrive at their destination
+        incidence = np.zeros((n, E))
+        np.add.at(incidence, (dst, np.arange(E)), 1)
+        np.add.at(incidence, (src, np.arange(E)), -1)
+        keep = 1 - self.U_frac_dt_loss
+
+        with get_telemetry().span("time_loop", steps=steps):
+            u = self.U_0.copy()
+            du = np.zeros((n, K))
+            for i, row in enumerate(self.inputs[:steps]):
+                u[idx] = row
+                du[idx] = row[:, None] * input_slope
+                if i == steps - 1:
+                    break
+                demand = a * u[src]
+                dflow = np.where(
+                    (demand <= self.dt * p)[:, None], a[:, None] * du[src], self.dt * dp
+                )
+                v = (u + self.dU(u)) * keep
+                dv = (du + incidence @ dflow) * keep[:, None]
+                du = np.where((v <= self.U_max)[:, None], dv, dU_max)
+                u = np.fmin(v, self.U_max)
+        self.final = u
+        self.steps = steps
+        self._input_total = self.inputs[:steps].sum(axis=0).sum(axis=-1)
+        self.__dict__.pop("us", None)
+        return du
 
     def plot(self, ax, exclude_cls_or_names=None):
         for i in range(self.us.shape[1]):
@@ -82,15 +758,11 @@ class EnergySystem:
 
     @property
     def total_useful(self):
-        return self.us[-1, self.g.inspect_ordering().index("OUTPUT")]
+        return self.final[..., self.g.inspect_ordering().index("OUTPUT")]
 
     @property
     def total_input(self):
-        return sum(
-            self.us[:, i].sum()
-            for i in range(self.us.shape[1])
-            if self.g.nodes[i].__dict__.get("outputs")
-        )
+        return self._input_total
 
     @property
     def net_efficiency(self):
@@ -98,23 +770,134 @@ class EnergySystem:
 
     @property
     def total_lost(self):
-        return self.us[-1, self.g.inspect_ordering().index("LOST")]
+        return self.final[..., self.g.inspect_ordering().index("LOST")]
 
 
 def basic_system(
     pv_spend, battery_spend, electrolyser_spend, h2storage_spend
 ) -> EnergySystem:
-    out = EnergyStore(value=0, name="OUTPUT")
-    sun = Sun(purchased=pv_spend)
-    sun.link_to(
-        Battery(purchased=battery_spend),
-        using=PVProcessToBatteryConnection,
-        purchased=pv_spend,
-    ).node_to.link_to(
-        H2Refueler(purchased=h2storage_spend),
-        using=BatteryConnectionToElectrolyserCompressorProcess,
-        purchased=electrolyser_spend,
-    ).node_to.link_to(
-        out
-    )
-    return EnergySystem(add_energy_sinks(sun.to_graph()))
+    with get_telemetry().span("build"):
+        out = EnergyStore(value=0, name="OUTPUT")
+        sun = Sun(purchased=pv_spend)
+        battery = Battery(purchased=battery_spend)
+        h2storage = H2Refueler(purchased=h2storage_spend)
+        pv = sun.link_to(
+            battery, using=PVProcessToBatteryConnection, purchased=pv_spend
+        )
+        electrolyser = battery.link_to(
+            h2storage,
+            using=BatteryConnectionToElectrolyserCompressorProcess,
+            purchased=electrolyser_spend,
+        )
+        h2storage.link_to(out)
+        s = EnergySystem(add_energy_sinks(sun.to_graph()))
+        s.spend_groups = [[sun, pv], [battery], [electrolyser], [h2storage]]
+    return s
+
+
+class SystemTemplate:
+    """A system topology compiled once, mapping spends straight to the arrays of `EnergySystem`.
+
+    Capacities, power limits and PV output are affine in the spends (see `spend_groups`),
+    so a system, or a stack of them, for new spends takes a few array operations
+    instead of building and compiling a graph. The results are identical to building each system.
+    Only the spends vary; everything else is taken from the reference `system`.
+    """
+
+    def __init__(self, system: EnergySystem, spend_groups=None):
+        groups = system.spend_groups if spend_groups is None else spend_groups
+        if groups is None:
+            raise ValueError("No spend groups given.")
+        if system.U_max.ndim > 1:
+            raise ValueError("Cannot make a template of stacked systems.")
+        self.system = system
+        self.spend_groups = groups
+        c = system.g.compile()
+        # (group, where, installation cost, cost per unit) of each affine entry
+        self._stores, self._processes, self._inputs = [], [], []
+        for k, group in enumerate(groups):
+            for item in group:
+                if isinstance(item, Edge):
+                    ij = (c.index[item.node_from], c.index[item.node_to])
+                    self._processes.append(
+                        (k, ij, item.installation_cost, item.specific_power_cost)
+                    )
+                elif c.index[item] in system.input_nodes:
+                    # PV output is proportional to the nameplate capacity; see `Sun`
+                    m = system.input_nodes.index(c.index[item])
+                    per_kw = resample_inputs(item.profile.per_kw(), HOUR, system.dt)
+                    self._inputs.append(
+                        (
+                            k,
+                            (m, per_kw),
+                            item.installation_cost,
+                            item.specific_energy_cost * KILO * HOUR,
+                        )
+                    )
+                else:
+                    self._stores.append(
+                        (
+                            k,
+                            c.index[item],
+                            item.installation_cost,
+                            item.specific_energy_cost,
+                        )
+                    )
+
+    @classmethod
+    def basic(cls, spends=(1e5, 1e5, 1e5, 1e5)) -> "SystemTemplate":
+        """The template of `basic_system`; the reference spends do not matter."""
+        return cls(basic_system(*spends))
+
+    def valid(self, spends) -> np.ndarray:
+        """Whether each spend vector buys a positive PV capacity, as `Sun` requires."""
+        spends = np.asarray(spends, dtype=np.float64)
+        ok = np.ones(spends.shape[:-1], dtype=bool)
+        for k, _, installation_cost, _ in self._inputs:
+            ok &= spends[..., k] > installation_cost
+        return ok
+
+    def arrays(self, spends) -> dict:
+        """The keyword arguments of `EnergySystem.from_arrays` for spends of shape (*scenarios, groups)."""
+        spends = np.asarray(spends, dtype=np.float64)
+        if spends.shape[-1] != len(self.spend_groups):
+            raise ValueError(
+                f"Expected {len(self.spend_groups)} spends, not {spends.shape[-1]}."
+            )
+        if not self.valid(spends).all():
+            raise ValueError("PV capacity must be positive.")
+        s = self.system
+        lead = spends.shape[:-1]
+        n = s.U_max.shape[-1]
+        U_max = np.broadcast_to(s.U_max, (*lead, n)).copy()
+        P = np.broadcast_to(s.process_power_limits, (*lead, n, n)).copy()
+        steps, k = s.inputs.shape
+        inputs = np.broadcast_to(
+            s.inputs.reshape(steps, *(1,) * len(lead), k), (steps, *lead, k)
+        ).copy()
+        for g, j, installation_cost, cost in self._stores:
+            U_max[..., j] = (spends[..., g] - installation_cost) / cost
+        for g, (i, j), installation_cost, cost in self._processes:
+            P[..., i, j] = (spends[..., g] - installation_cost) / cost
+        for g, (m, per_kw), installation_cost, cost in self._inputs:
+            capacity = (spends[..., g] - installation_cost) / cost
+            inputs[..., m] = per_kw.reshape(-1, *(1,) * len(lead)) * capacity * WH
+        return dict(
+            U_0=s.U_0,
+            U_max=U_max,
+            U_frac_dt_loss=np.broadcast_to(s.U_frac_dt_loss, (*lead, n)),
+            weighted_A=np.broadcast_to(s.weighted_A, (*lead, n, n)),
+            process_power_limits=P,
+            input_nodes=s.input_nodes,
+            inputs=inputs,
+        )
+
+    def __call__(self, spends) -> EnergySystem:
+        """The system for a spend vector, or a stack of systems for an array of them."""
+        with get_telemetry().span("build"):
+            return EnergySystem.from_arrays(
+                self.system.g,
+                **self.arrays(spends),
+                dt=self.system.dt,
+                kernel=self.system.kernel,
+            )
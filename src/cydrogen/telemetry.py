@@ -0,0 +1,154 @@
+"""Structured events for profiling simulations and optimiser runs.
+
+Timed spans (e.g. graph build, PV fetch, time loop) and counters (e.g. cache hits,
+failures, penalty returns) are sent as flat dicts to one or more sinks.
+Nothing is recorded unless a `Telemetry` is active, so instrumented code costs almost nothing otherwise.
+
+Example
+-------
+```py
+with Telemetry(RingBuffer(), JSONLines("run.jsonl")) as t:
+    opt()
+print(t.report())
+```
+"""
+import abc
+import collections
+import contextlib
+import json
+import os
+import time
+from typing import Optional
+
+
+class Sink(abc.ABC):
+    @abc.abstractmethod
+    def emit(self, event: dict) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class RingBuffer(Sink):
+    """Keep the last `maxlen` events in memory."""
+
+    def __init__(self, maxlen: int = 100_000):
+        self.events = collections.deque(maxlen=maxlen)
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+class JSONLines(Sink):
+    """Append each event as a line of JSON to a file."""
+
+    def __init__(self, path: os.PathLike):
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+
+    def emit(self, event):
+        self._file.write(json.dumps(event, default=repr) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class Telemetry:
+    """Send spans, counts and other events to `sinks`, keeping totals for `summary`.
+
+    Spans are inclusive: e.g. "build" includes the "pv_fetch" of the `Sun` it builds.
+    Events from other processes (e.g. optimiser workers) are not collected.
+    """
+
+    enabled = True
+
+    def __init__(self, *sinks: Sink):
+        self.sinks = sinks
+        self.counters = collections.Counter()
+        self.spans = collections.defaultdict(lambda: [0, 0.0, 0.0])  # count, total, max
+        self._previous = []
+
+    def event(self, kind: str, **fields) -> None:
+        event = {"event": kind, "time": time.time(), **fields}
+        for sink in self.sinks:
+            sink.emit(event)
+
+    def count(self, name: str, n: int = 1, **fields) -> None:
+        self.counters[name] += n
+        self.event("count", name=name, n=n, **fields)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **fields):
+        """Time the enclosed block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            stats = self.spans[name]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            self.event("span", name=name, duration=duration, **fields)
+
+    def summary(self) -> dict:
+        return {
+            "spans": {
+                name: {"count": c, "total": t, "mean": t / c, "max": m}
+                for name, (c, t, m) in self.spans.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+    def report(self) -> str:
+        """A table of span timings and counters."""
+        lines = [
+            f"{'span':<16}{'count':>8}{'total (s)':>12}{'mean (s)':>12}{'max (s)':>12}"
+        ]
+        for name, s in self.summary()["spans"].items():
+            lines.append(
+                f"{name:<16}{s['count']:>8}{s['total']:>12.4f}{s['mean']:>12.6f}{s['max']:>12.6f}"
+            )
+        for name, n in self.counters.items():
+            lines.append(f"{name:<16}{n:>8}")
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self) -> "Telemetry":
+        self._previous.append(get_telemetry())
+        set_telemetry(self)
+        return self
+
+    def __exit__(self, *exc):
+        set_telemetry(self._previous.pop())
+
+
+class _Disabled(Telemetry):
+    enabled = False
+
+    def event(self, kind, **fields):
+        pass
+
+    def count(self, name, n=1, **fields):
+        pass
+
+    def span(self, name, **fields):
+        return contextlib.nullcontext()
+
+
+_disabled = _Disabled()
+_telemetry: Telemetry = _disabled
+
+
+def get_telemetry() -> Telemetry:
+    """The active telemetry, which records nothing unless one has been set."""
+    return _telemetry
+
+
+def set_telemetry(telemetry: Optional[Telemetry]):
+    global _telemetry
+    _telemetry = _disabled if telemetry is None else telemetry
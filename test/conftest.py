@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+import cydrogen
+from cydrogen import ArrayProfile
+
+DAY = np.clip(np.sin(np.linspace(0, 2 * np.pi, 24)), 0, None) * 1000
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    """Use the same clear day all year as the default PV profile, instead of fetching one."""
+    profile = ArrayProfile(np.tile(DAY, 365))
+    monkeypatch.setattr(cydrogen.profiles, "_default_profile", profile)
+    return profile
+
+
+@pytest.fixture
+def cloudy(monkeypatch):
+    """As `offline`, with each day scaled by a random cloud cover."""
+    cloud = np.random.default_rng(0).uniform(0.3, 1, 365)
+    profile = ArrayProfile(np.repeat(cloud, 24) * np.tile(DAY, 365))
+    monkeypatch.setattr(cydrogen.profiles, "_default_profile", profile)
+    return profile
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from cydrogen import EnergySystem, FinalState, RepresentativeDays, SystemTemplate
+from cydrogen.graph import Edge, Graph, Node
+
+
+def test_clustering(cloudy):
+    days = RepresentativeDays.from_profile(cloudy, k=12)
+    assert len(days.days) <= 12 and days.weights.sum() == 365
+    assert np.array_equal(days.sequence[days.days], np.arange(len(days.days)))
+    per_day = cloudy.per_kw().reshape(365, 24)
+    expanded = days.expand(cloudy.per_kw()).reshape(365, 24)
+    assert np.array_equal(expanded, per_day[days.days[days.sequence]])
+    assert 0 < days.input_error < 0.05
+    every = RepresentativeDays.from_profile(cloudy, k=365)
+    assert np.array_equal(every.expand(cloudy.per_kw()), cloudy.per_kw())
+
+
+def test_simulate(cloudy):
+    days = RepresentativeDays.from_profile(cloudy, k=12)
+    X = np.array([[2.5e5] * 4, [5e5, 1e6, 1e4, 1e4]])
+    s = SystemTemplate.basic()(X)
+    approx = days.simulate(s)
+    full = s.simulate(FinalState())
+    j = s.g.inspect_ordering().index("OUTPUT")
+    assert np.allclose(approx[..., j], full[..., j], rtol=0.01)
+    assert np.allclose(days.error(s), np.abs(approx - full)[..., j] / full[..., j])
+    # the bound holds for the full year with every day replaced by its representative
+    s.simulate(FinalState(), inputs=days.expand(s.inputs))
+    assert (
+        np.abs(s.final - full).sum(axis=-1) <= days.expand_error_bound(s) * (1 + 1e-9)
+    ).all()
+    s.weighted_A = s.weighted_A * 2
+    with pytest.raises(ValueError):
+        days.expand_error_bound(s)
+    with pytest.raises(ValueError):
+        days.simulate(s, cycles=0)
+
+
+def test_expand_error_bound_inputs(cloudy):
+    # PV sends on twice the energy of its step, on a day and a cloudier one
+    day = cloudy.per_kw()[:24]
+    nodes = [Node(name=name) for name in ("PV", "OUTPUT")]
+    A = np.array([[0, 2], [0, 0]], dtype=np.float64)
+    s = EnergySystem.from_arrays(
+        Graph(nodes, [Edge(nodes[0], nodes[1])]),
+        U_0=np.zeros(2),
+        U_max=np.full(2, np.inf),
+        U_frac_dt_loss=np.zeros(2),
+        weighted_A=A,
+        process_power_limits=np.where(A != 0, np.inf, 0),
+        input_nodes=(0,),
+        inputs=np.concatenate([day, day / 2])[:, None],
+    )
+    days = RepresentativeDays.from_inputs(s.inputs, k=1, steps_per_day=24)
+    full = s.simulate(FinalState(), steps=48).copy()
+    expanded = s.simulate(FinalState(), steps=48, inputs=days.expand(s.inputs))
+    error = np.abs(expanded - full).sum()
+    assert np.abs(s.inputs - days.expand(s.inputs)).sum() < error
+    assert error <= days.expand_error_bound(s) * (1 + 1e-9)
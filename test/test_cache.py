@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from cydrogen.cache import CacheMiss, EvaluationCache, ProfileCache
+
+
+def response(scale=1.0):
+    return {
+        "inputs": {"system_capacity": str(scale)},
+        "outputs": {"ac": list(np.arange(8760) * scale), "ac_annual": 1.0},
+    }
+
+
+def test_fetch_once(tmp_path):
+    cache = ProfileCache(tmp_path)
+    calls = []
+
+    def request():
+        calls.append(1)
+        return response()
+
+    params = {"lat": 34.88, "lon": 33.63}
+    first = cache.fetch(params, request)
+    second = ProfileCache(tmp_path).fetch(params, request)
+    assert len(calls) == 1
+    assert isinstance(second["outputs"]["ac"], np.memmap)
+    assert np.array_equal(first["outputs"]["ac"], second["outputs"]["ac"])
+    assert second["inputs"] == {"system_capacity": "1.0"}
+    assert second["outputs"]["ac_annual"] == 1.0
+
+
+def test_failures_not_cached(tmp_path):
+    cache = ProfileCache(tmp_path)
+    cache.fetch({}, lambda: {"errors": ["OVER_RATE_LIMIT"]})
+    assert cache.get({}) is None
+
+
+def test_offline(tmp_path):
+    cache = ProfileCache(tmp_path, offline=True)
+    with pytest.raises(CacheMiss):
+        cache.fetch({"lat": 0}, response)
+
+
+@pytest.mark.parametrize(
+    "value, offline",
+    [("", False), ("0", False), ("false", False), ("Off", False), ("1", True)],
+)
+def test_offline_env(tmp_path, monkeypatch, value, offline):
+    monkeypatch.setenv("CYDROGEN_OFFLINE", value)
+    assert ProfileCache(tmp_path).offline is offline
+
+
+def test_evict(tmp_path):
+    cache = ProfileCache(tmp_path)
+    for i in range(3):
+        cache.fetch({"i": i}, response)
+    entry_size = cache.size_bytes // 3
+    cache.get({"i": 0})  # most recently used now
+    cache.max_bytes = 2 * entry_size
+    cache.evict()
+    assert cache.get({"i": 0}) is not None
+    assert cache.get({"i": 1}) is None
+    assert cache.get({"i": 2}) is not None
+
+
+def test_evaluation_cache_lru():
+    cache = EvaluationCache(maxsize=2)
+    keys = [cache.key(np.array([x, 1.0])) for x in range(3)]
+    assert len(set(keys)) == 3
+    assert cache.key(np.array([0.0, 1.0]), {"a": 1}) != keys[0]
+    for k in keys:
+        cache.put(k, 1)
+    assert cache.get(keys[0]) is None and cache.get(keys[2]) == 1
+    assert cache.info()["hits"] == cache.info()["misses"] == 1
+    quantised = EvaluationCache(digits=3)
+    assert quantised.key([1.0001e5]) == quantised.key([1e5])
+    assert EvaluationCache().key([1.0001e5]) != EvaluationCache().key([1e5])
+
+
+def test_evaluation_cache_persistence(tmp_path):
+    cache = EvaluationCache(path=tmp_path / "evals.sqlite")
+    cache.put(cache.key([1.0, 2.0]), 3.0)
+    other = EvaluationCache(path=tmp_path / "evals.sqlite")
+    assert other.get(other.key([1.0, 2.0])) == 3.0
+    other.clear()
+    assert cache.get(cache.key([1.0, 2.0])) == 3.0  # still in memory
+    assert (
+        EvaluationCache(path=tmp_path / "evals.sqlite").get(cache.key([1.0, 2.0]))
+        is None
+    )
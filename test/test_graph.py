@@ -1,3 +1,5 @@
+import numpy as np
+import pytest
 from cydrogen.graph import Graph, Node, Edge
 
 
@@ -26,3 +28,75 @@ def test_factories():
     assert g.edges == G.edges
     assert g.cardinality == G.cardinality == 5
     assert g.nodes - G.nodes == G.nodes - g.nodes == set()
+
+
+def test_compile():
+    a = Node(1, name="a")
+    b = Node(2, name="b")
+    Edge(a, b, 3)
+    g = a.to_graph()
+    c = g.compile()
+    assert g.compile() is c
+    assert c.index[a] == 0 and c.index[b] == 1
+    assert list(c.src) == [0] and list(c.dst) == [1]
+    assert list(c.node_column("value")) == [1, 2]
+    assert list(c.edge_column("weight")) == [3]
+    assert (c.adjacency(c.edge_column("weight")) == [[0, 3], [0, 0]]).all()
+    b.link_to(a, 4)
+    c2 = g.compile()
+    assert c2 is not c
+    assert sorted(zip(c2.src, c2.dst)) == [(0, 1), (1, 0)]
+    g.add_node(Node(name="c"))
+    assert len(g.compile().nodes) == 3
+
+
+def test_compile_per_component():
+    g = Graph.Kn(3)
+    c = g.compile()
+    # other graphs changing does not make the snapshot stale
+    Graph.Kn(4)
+    x, y = Node(name="x"), Node(name="y")
+    x.link_to(y, using=Edge)
+    x.link_to(y, using=Edge)
+    assert g.compile() is c
+    # linking into the graph's component does, whichever root the merge keeps
+    y.link_to(g.nodes[0])
+    c2 = g.compile()
+    assert c2 is not c
+    g.nodes[1].link_to(g.nodes[1])
+    assert g.compile() is not c2
+
+
+def test_from_edges():
+    g = Graph.from_edges([0, 1, 2], [1, 2, 0], [0.5, 1, 2])
+    assert g.cardinality == 3
+    assert (
+        g.get_adjacency_matrix(lambda e: e.weight)
+        == [[0, 0.5, 0], [0, 0, 1], [2, 0, 0]]
+    ).all()
+    assert Graph.from_edges([0], [0], n=4).cardinality == 4
+    with pytest.raises(ValueError):
+        Graph.from_edges([0, 0], [1, 1])
+
+
+def test_from_sparse_matrix():
+    import scipy.sparse
+
+    A = scipy.sparse.random(50, 50, density=0.1, random_state=0, format="csr")
+    g = Graph.from_adjacency_matrix(A)
+    assert len(g.edges) == A.nnz
+    assert np.allclose(g.get_adjacency_matrix(lambda e: e.weight), A.toarray())
+
+
+def test_components():
+    a, b, c, d = (Node(name=x) for x in "abcd")
+    a.link_to(b)
+    c.link_to(d)
+    assert set(a.component()) == {a, b}
+    assert set(d.to_graph().nodes) == {c, d}
+    assert d.to_graph().nodes[0] is d
+    d.link_to(b)
+    g = c.to_graph()
+    assert g.nodes[0] is c
+    assert set(g.nodes) == {a, b, c, d}
+    assert g.edges == a.edges_out | c.edges_out | d.edges_out
@@ -1,5 +1,7 @@
 import numpy as np
 import pytest
+from pypvwatts.pypvwatts import PVWattsResult
+import cydrogen.profiles
 from cydrogen import (
     EnergyStore,
     BatteryConnection,
@@ -7,6 +9,7 @@ from cydrogen import (
     Sun,
     Battery,
     H2Refueler,
+    PVWattsProfile,
     BatteryConnectionToElectrolyserCompressorProcess,
     basic_system,
     HOUR,
@@ -61,3 +64,28 @@ def test_max_power_transfer():
         (d[:, [s.g.nodes.index(e.node_to) for e in s.g.edges]] <= mpt)
         & (d[:, [s.g.nodes.index(e.node_from) for e in s.g.edges]] >= -mpt)
     )
+
+
+def test_Sun_scales_reference_profile(monkeypatch):
+    calls = []
+
+    def request(**params):
+        calls.append(params)
+        return PVWattsResult(
+            {
+                "inputs": {"system_capacity": str(params["system_capacity"])},
+                "outputs": {"ac": list(np.linspace(0, 1000, 8760)), "ac_annual": 1.0},
+            }
+        )
+
+    monkeypatch.setattr(cydrogen.profiles, "request_pvwatts", request)
+    profile = PVWattsProfile(lat=0, lon=0)
+    a = Sun(purchased=3950, profile=profile)
+    b = Sun(purchased=3000 + 7 * 950, profile=PVWattsProfile(lat=0, lon=0))
+    assert len(calls) == 1
+    assert calls[0]["system_capacity"] == 1
+    assert b.inputs["system_capacity"] == pytest.approx(7)
+    assert np.allclose(b.outputs["ac"], 7 * a.outputs["ac"])
+    assert b.outputs["ac_annual"] == pytest.approx(7)
+    with pytest.raises(ValueError):
+        Sun(purchased=3000, profile=profile)
@@ -0,0 +1,268 @@
+import multiprocessing
+import numpy as np
+import pytest
+import scipy.optimize
+from scipy.optimize._numdiff import approx_derivative
+import cydrogen
+from cydrogen.cache import EvaluationCache
+from cydrogen.optimise import BudgetAllocator, MinimiseHEVBudget, Optimiser
+
+
+def allocator(**kw):
+    opt = BudgetAllocator({"x0": np.ones(3) / 4, "bounds": [(0, 1)] * 3}, **kw)
+    opt.total_budget = 1e6
+    return opt
+
+
+def test_objective_batch(offline):
+    X = np.array([[0.25, 0.25, 0.25], [0.5, 0.1, 0.2], [0.6, 0.3, 0.3], [0, 0, 0]])
+    serial = [allocator().objective(x) for x in X]
+    assert np.array_equal(allocator().objective_batch(X), serial)
+    assert np.array_equal(allocator(workers=map).objective_batch(X), serial)
+    assert serial[2] == serial[3] == BudgetAllocator.BAD_VALUE
+
+
+@pytest.mark.parametrize("scheme", ["2-point", "3-point"])
+@pytest.mark.parametrize("x", [[0.25, 0.25, 0.25], [0.5, 0.1, 1.0], [0, 0.3, 0.2]])
+def test_gradient(offline, scheme, x):
+    opt = allocator()
+    expected = approx_derivative(
+        opt.objective, np.array(x), method=scheme, bounds=([0] * 3, [1] * 3)
+    )
+    f0, g = opt.value_and_gradient(np.array(x), scheme)
+    assert f0 == opt.objective(np.array(x))
+    assert np.array_equal(g, expected)
+    assert np.array_equal(opt.gradient(np.array(x), scheme, f0=f0), expected)
+
+
+def test_jac_option(offline):
+    opt = MinimiseHEVBudget(
+        {
+            "x0": np.array([5e4, 5e4, 5e4, 5e4]),
+            "bounds": [(3500, None)] + [(0, None)] * 3,
+            "method": "L-BFGS-B",
+            "jac": "2-point",
+            "options": {"maxiter": 2},
+        }
+    )
+    opt.output_limit = 1e9
+    assert opt.options["jac"] is True
+    x0 = opt.options["x0"]
+    expected = approx_derivative(
+        opt.objective, x0, method="2-point", bounds=([3500, 0, 0, 0], np.inf)
+    )
+    assert np.array_equal(opt.gradient(x0), expected)
+    assert isinstance(opt(), scipy.optimize.OptimizeResult)
+
+
+def test_exact_jac(offline):
+    opt = allocator()
+    for x in ([0.25, 0.25, 0.25], [0.4, 0.1, 0.05]):
+        x = np.array(x)
+        f, g = opt.value_and_jac(x)
+        assert f == opt.objective(x)
+        fd = approx_derivative(opt.objective, x, method="3-point", rel_step=1e-6)
+        assert np.allclose(g, fd, rtol=1e-4)
+    assert opt.value_and_jac(np.array([0.6, 0.3, 0.3]))[0] == opt.BAD_VALUE
+
+
+def test_output_constraint(offline):
+    opt = MinimiseHEVBudget({"x0": np.array([1e5, 5e4, 5e4, 5e4])})
+    opt.output_limit = 1e10
+    con = opt.constraint()
+    x = opt.options["x0"]
+    fd = approx_derivative(opt.output, x, method="3-point", rel_step=1e-6)
+    assert np.allclose(con.jac(x), fd, rtol=1e-4)
+    feasible = opt.objective(x) != opt.BAD_VALUE
+    assert (con.fun(x) > opt.output_limit) == feasible
+    # spends that buy no PV produce nothing, instead of failing to build the system
+    x = np.array([3000, 5e4, 5e4, 5e4])
+    assert con.fun(x) == 0 and not con.jac(x).any()
+
+
+def test_no_exact_jac(offline):
+    assert not hasattr(MinimiseHEVBudget, "value_and_jac")
+    with pytest.raises(ValueError, match="no exact gradient"):
+        MinimiseHEVBudget({"x0": np.ones(4), "jac": "exact"})
+
+
+def test_cache(offline):
+    cache = EvaluationCache()
+    opt = allocator(cache=cache)
+    x = np.array([0.25, 0.25, 0.25])
+    f0, g = opt.value_and_gradient(x)
+    assert cache.info() == {"hits": 0, "misses": 4, "size": 4, "maxsize": 4096}
+    assert opt.evaluate(x) == f0 and cache.hits == 1
+    assert np.array_equal(opt.value_and_gradient(x)[1], g) and cache.hits == 5
+    other = allocator(cache=cache)
+    other.total_budget = 2e6
+    other.evaluate(x)
+    assert cache.misses == 5
+
+
+def test_invalid_spends(offline):
+    # no PV: recorded as a failure, as without the template, and not cached
+    opt = allocator(cache=EvaluationCache())
+    X = np.array([[0, 0.3, 0.3], [0.25, 0.25, 0.25]])
+    with cydrogen.Telemetry() as t:
+        out = opt.objective_batch(X)
+        assert opt.evaluate(X[0]) == out[0] == opt.BAD_VALUE
+    assert t.counters["failure"] == 2 and opt.cache.info()["size"] == 1
+
+
+class Shifted(Optimiser):
+    """A quadratic bowl with a plateau at `BAD_VALUE`, recording the batches evaluated."""
+
+    def objective(self, xs):
+        if xs[0] > 3:
+            return self.BAD_VALUE
+        return float(((xs - [1, 2, -1]) ** 2).sum())
+
+    def _objective_batch(self, X):
+        self.batches.append(len(X))
+        return super()._objective_batch(X)
+
+
+@pytest.mark.parametrize("method", ["differential-evolution", "cma-es"])
+def test_population_methods(method):
+    opt = Shifted(
+        {
+            "x0": np.array([2.5, 0, 0]),
+            "bounds": [(-5, 5)] * 3,
+            "method": method,
+            "callback": None,
+            "options": {"seed": 0, "popsize": 12, "maxiter": 200},
+        }
+    )
+    opt.batches = []
+    r = opt()
+    assert np.allclose(r.x, [1, 2, -1], atol=1e-3)
+    # one batch per generation, rather than one call per candidate
+    assert len(opt.batches) <= 201 + (method == "differential-evolution")
+    assert max(opt.batches) >= 12
+
+
+def test_differential_evolution_needs_bounds():
+    opt = Shifted({"x0": np.zeros(3), "method": "differential-evolution"})
+    with pytest.raises(ValueError, match="finite bounds"):
+        opt()
+
+
+def test_surrogate():
+    opt = Shifted(
+        {
+            "x0": np.array([2.5, 0, 0]),
+            "bounds": [(-5, 5)] * 3,
+            "method": "surrogate",
+            "callback": None,
+            "options": {"seed": 0, "maxiter": 40},
+        }
+    )
+    opt.batches = []
+    r = opt()
+    assert np.allclose(r.x, [1, 2, -1], atol=0.1)
+    assert r.nfev == sum(opt.batches) == len(r.y) <= 48
+    again = opt.__class__({**opt.options, "options": {"history": (r.X, r.y)}})
+    again.batches = []
+    assert again().fun <= r.fun
+
+
+def test_pool_closed():
+    opt = Shifted({"x0": np.array([2.5, 0, 0]), "method": "cma-es", "callback": None})
+    opt.workers = 2
+    opt.batches = []
+    opt.options["options"] = {"seed": 0, "maxiter": 3}
+    opt()
+    assert opt._pool is None
+    with Shifted({"x0": np.zeros(3)}, workers=2) as opt:
+        opt.batches = []
+        opt.objective_batch(np.zeros((2, 3)))
+        assert opt._pool is not None
+    assert opt._pool is None
+
+
+def test_pool_default_profile(offline, monkeypatch):
+    # spawned workers start from a fresh import, without the profile set here
+    monkeypatch.setenv("CYDROGEN_OFFLINE", "1")
+    monkeypatch.setattr(
+        multiprocessing, "Pool", multiprocessing.get_context("spawn").Pool
+    )
+    X = np.array([[0.25, 0.25, 0.25], [0.3, 0.3, 0.2]])
+    serial = allocator().objective_batch(X)
+    assert (serial < Optimiser.BAD_VALUE).all()
+    with allocator(workers=2) as opt:
+        assert np.array_equal(opt.objective_batch(X), serial)
+
+
+def test_custom_fun():
+    def fun(xs):
+        return float((xs**2).sum())
+
+    opt = Shifted({"x0": np.ones(3), "fun": fun, "jac": "2-point", "method": "BFGS"})
+    assert opt.options["fun"] is fun and opt.options["jac"] == "2-point"
+    assert np.allclose(opt().x, 0, atol=1e-4)
+    with pytest.raises(ValueError, match="custom"):
+        Shifted({"x0": np.ones(3), "fun": fun, "jac": "exact"})
+
+
+class Flaky(Shifted):
+    """Fails on its first evaluation at each point."""
+
+    def objective(self, xs):
+        if tuple(xs) not in self.seen:
+            self.seen.add(tuple(xs))
+            raise RuntimeError("transient")
+        return super().objective(xs)
+
+
+def test_failures_not_cached():
+    cache = EvaluationCache()
+    opt = Flaky({"x0": np.zeros(3)}, cache=cache)
+    opt.seen, opt.batches = set(), []
+    x = np.array([1.0, 2, -1])
+    assert opt.evaluate(x) == opt.BAD_VALUE
+    assert opt.evaluate(x) == 0
+    X = np.array([[0.0, 0, 0], [5, 0, 0]])
+    assert (opt.objective_batch(X) == opt.BAD_VALUE).all()
+    assert np.array_equal(opt.objective_batch(X), [6, opt.BAD_VALUE])
+    # the over-budget penalty is cached, the failures are not
+    assert cache.info()["size"] == 3
+    assert opt.cache_context()["version"] == cydrogen.__version__
+
+
+class Plateau(Optimiser):
+    """The sum of `xs`, with a penalty plateau below 150."""
+
+    def objective(self, xs):
+        return self.BAD_VALUE if xs.sum() < 150 else float(xs.sum())
+
+
+def test_cma_es_plateau():
+    options = {
+        "x0": np.full(3, 10.0),
+        "bounds": [(0, 100)] * 3,
+        "method": "cma-es",
+        "callback": None,
+        "options": {"sigma0": 0.1, "seed": 0},
+    }
+    r = Plateau(options)()
+    assert r.success and r.nit > 1 and r.fun == pytest.approx(150)
+    options["bounds"] = [(0, 40)] * 3  # the plateau covers every feasible point
+    options["options"]["maxiter"] = 50
+    r = Plateau(options)()
+    assert not r.success and r.fun == Plateau.BAD_VALUE
+
+
+def test_surrogate_plateau():
+    options = {
+        "x0": np.full(3, 10.0),
+        "bounds": [(0, 40)] * 3,  # the plateau covers every feasible point
+        "method": "surrogate",
+        "callback": None,
+        "options": {"maxiter": 5, "seed": 0},
+    }
+    r = Plateau(options)()
+    assert not r.success and r.fun == Plateau.BAD_VALUE
+    assert "bad_value" in r.message
+    options["bounds"] = [(0, 100)] * 3
+    assert Plateau(options)().success
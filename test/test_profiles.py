@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+import cydrogen
+from cydrogen import (
+    ArrayProfile,
+    CSVProfile,
+    NpyProfile,
+    Sun,
+    basic_system,
+    save_profiles,
+)
+
+
+def write_csv(path, ac):
+    with open(path, "w") as f:
+        f.write("Requested Location,Larnaca\n")
+        f.write('"Month","Day","Hour","AC System Output (W)"\n')
+        for i, x in enumerate(ac):
+            f.write(f"1,{i // 24 + 1},{i % 24},{x}\n")
+
+
+def test_CSVProfile(tmp_path):
+    ac = np.linspace(0, 5000, 8760)
+    write_csv(tmp_path / "a.csv", ac)
+    profile = CSVProfile(tmp_path / "a.csv", header_row=1, scale=1 / 5)
+    assert np.allclose(profile.per_kw(), ac / 5)
+    assert np.allclose(
+        CSVProfile(tmp_path / "a.csv", column=3, header_row=1).per_kw(), ac
+    )
+    s = Sun(purchased=3000 + 2 * 950, profile=profile)
+    assert s.inputs["system_capacity"] == pytest.approx(2)
+    assert np.allclose(s.outputs["ac"], 2 * ac / 5)
+
+
+def test_NpyProfile(tmp_path):
+    sources = [ArrayProfile(np.full(8760, i)) for i in range(3)]
+    save_profiles(sources, tmp_path / "sites.npy")
+    assert np.array_equal(
+        NpyProfile(tmp_path / "sites.npy", site=2).per_kw(), sources[2].ac
+    )
+    assert NpyProfile(tmp_path / "sites.npy").per_kw().shape == (3, 8760)
+    with pytest.raises(ValueError):
+        save_profiles([], tmp_path / "none.npy")
+
+
+def test_offline_system(offline):
+    s = basic_system(*[2.5e5] * 4)
+    s.simulate()
+    assert 0 < s.total_useful < s.total_input
+
+
+def test_iter_simulate_chunks(offline):
+    s = basic_system(*[2.5e5] * 4)
+    us = s.simulate()
+    year = s.total_useful
+    # the same year, streamed in uneven chunks and yielded in days
+    chunks = np.array_split(s.inputs, [1, 100, 5000])
+    blocks = list(s.iter_simulate(iter(chunks), block=24))
+    assert all(len(b) == 24 for b in blocks)
+    assert np.array_equal(np.concatenate(blocks), us)
+    # a decade, without holding it in memory
+    decade = (s.inputs for _ in range(10))
+    final = s.simulate(cydrogen.FinalState(), steps=10 * 8760, inputs=decade)
+    assert final[s.g.inspect_ordering().index("OUTPUT")] > 9 * year
+    with pytest.raises(ValueError):
+        s.simulate(steps=8761)
+
+
+def test_prefetch_profiles(tmp_path, monkeypatch):
+    import http.server
+    import json
+    import threading
+    import urllib.parse
+    from cydrogen import cache, profiles
+
+    requests_seen = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep connections alive
+
+        def do_GET(self):
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+            requests_seen.append((self.client_address, query))
+            if len(requests_seen) <= 2:
+                status, body = 429, {"error": {"code": "OVER_RATE_LIMIT"}}
+            else:
+                lat = float(query["lat"])
+                status, body = 200, {"inputs": query, "outputs": {"ac": [lat] * 8760}}
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        profiles.PVWatts, "PVWATTS_QUERY_URL", f"http://127.0.0.1:{server.server_port}"
+    )
+    monkeypatch.setattr(cache, "_profile_cache", cache.ProfileCache(tmp_path))
+    sites = [profiles.PVWattsProfile(lat=lat, lon=33.0) for lat in range(30, 40)]
+    try:
+        with cydrogen.Telemetry() as t:
+            results = profiles.prefetch_profiles(sites, workers=3, backoff=0.01)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert t.counters["rate_limited"] == 2
+    assert len(requests_seen) == len(sites) + 2
+    assert len({address for address, _ in requests_seen}) <= 3  # connections reused
+    assert requests_seen[0][1]["api_key"] == profiles.PVWatts.api_key
+    for site in sites:
+        assert np.all(results[site] == site.lat)
+        # served from the cache now that the server is gone
+        assert np.all(site.per_kw() == site.lat)
+    assert profiles.prefetch_profiles(sites)[sites[0]][0] == sites[0].lat
+
+
+def test_retry_after():
+    import email.utils
+    import time
+    from cydrogen.profiles import _retry_after
+
+    assert _retry_after("120") == 120
+    assert _retry_after(None) is None and _retry_after("soon") is None
+    later = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < _retry_after(later) <= 60
+    assert _retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
@@ -0,0 +1,98 @@
+import pickle
+import numpy as np
+import pytest
+import cydrogen
+from cydrogen import FinalState, ResultsStore, SystemTemplate
+
+
+@pytest.fixture
+def template(offline):
+    return SystemTemplate.basic()
+
+
+def test_save_load(tmp_path, offline):
+    store = ResultsStore(tmp_path)
+    s = cydrogen.basic_system(*[2.5e5] * 4)
+    us = s.simulate()
+    store.save(s, {"spends": np.array([2.5e5] * 4), "site": "a"}, dtype=np.float32)
+    run = ResultsStore(tmp_path).load({"site": "a", "spends": [2.5e5] * 4})
+    assert run.names == s.g.inspect_ordering()
+    assert run.classes[run.names.index("OUTPUT")] == "EnergyStore"
+    assert run.purchased[0] == s.g.nodes[0].purchased
+    j = run.names.index("OUTPUT")
+    column = run.column("OUTPUT")
+    assert isinstance(column, np.memmap) and column.dtype == np.float32
+    assert np.allclose(column, us[:, j], rtol=1e-6)
+    assert np.allclose(run.us, us, rtol=1e-6)
+    assert run.total_useful == s.total_useful
+    assert run.net_efficiency == s.net_efficiency
+    assert {"site": "b"} not in store
+    with pytest.raises(KeyError):
+        store.load({"site": "b"})
+
+
+def test_find(tmp_path, template):
+    store = ResultsStore(tmp_path)
+    X = np.array([[2.5e5] * 4, [5e5, 1e6, 1e4, 1e4]])
+    for site in ("a", "b"):
+        for i, x in enumerate(X):
+            s = template(x)
+            s.simulate(FinalState())
+            store.save(s, {"site": site, "i": i}, spends=x)
+    stacked = template(X)
+    stacked.simulate()
+    store.save(stacked, {"site": "a", "i": "both"}, spends=X)
+    # saving again replaces the run
+    store.save(stacked, {"site": "a", "i": "both"}, spends=X)
+    assert len(store) == 5
+    assert sorted(p["site"] for p in store.find(i=np.int64(1))) == ["a", "b"]
+    runs = {r.params["i"]: r for r in store.runs(site="a")}
+    assert runs.keys() == {0, 1, "both"}
+    assert np.array_equal(runs["both"].spends, X)
+    assert np.array_equal(runs["both"].total_useful, stacked.total_useful)
+    assert runs["both"].column("OUTPUT").shape == (8760, 2)
+    for i in range(2):
+        assert runs[i].total_useful == pytest.approx(stacked.total_useful[i])
+    with pytest.raises(ValueError):
+        runs[0].column("OUTPUT")
+    store.delete({"site": "b", "i": 0})
+    assert len(store) == 4 and {"site": "b", "i": 0} not in store
+    # e.g. for a process pool, reconnecting on use
+    assert len(pickle.loads(pickle.dumps(store))) == 4
+
+
+def test_params_must_be_json(tmp_path):
+    store = ResultsStore(tmp_path)
+    assert store.key({"x": np.float32(0.5)}) == store.key({"x": 0.5})
+    for value in (object(), {1, 2}):
+        with pytest.raises(TypeError):
+            store.key({"x": value})
+
+
+def test_interrupted_save(tmp_path, template, monkeypatch):
+    store = ResultsStore(tmp_path)
+    s = template([2.5e5] * 4)
+    s.simulate(FinalState())
+    store.save(s, {"site": "a"})
+    t = template([5e5, 1e6, 1e4, 1e4])
+    t.simulate(FinalState())
+    # the old run is moved aside, then the new one fails to take its place
+    replace = cydrogen.results.os.replace
+
+    def interrupted(src, dst):
+        if str(src).endswith(".tmp"):
+            raise OSError("interrupted")
+        replace(src, dst)
+
+    monkeypatch.setattr(cydrogen.results.os, "replace", interrupted)
+    with pytest.raises(OSError):
+        store.save(t, {"site": "a"})
+    monkeypatch.undo()
+    assert store.load({"site": "a"}).total_useful == s.total_useful
+    assert {"site": "a"} in store and len(store) == 1
+    # saving again replaces it and clears what was moved aside
+    store.save(t, {"site": "a"})
+    assert store.load({"site": "a"}).total_useful == t.total_useful
+    assert sorted(p.name for p in tmp_path.iterdir() if p.is_dir()) == [
+        store.key({"site": "a"})
+    ]
@@ -0,0 +1,79 @@
+import concurrent.futures
+import functools
+import multiprocessing
+import numpy as np
+import pytest
+import scipy.optimize
+from cydrogen import get_default_profile
+from cydrogen.sweep import load_result, run_sweep, save_result, scaled_neighbour
+
+
+def solve(point, x0):
+    return scipy.optimize.OptimizeResult(
+        x=np.ones(2) * point if x0 is None else np.asarray(x0),
+        fun=float(point),
+        success=True,
+        hess_inv=object(),
+    )
+
+
+def test_save_result(tmp_path):
+    save_result(tmp_path / "a.json", 10, solve(10, None))
+    point, result = load_result(tmp_path / "a.json")
+    assert point == 10 and result.fun == 10.0 and "hess_inv" not in result
+    assert np.array_equal(result.x, [10, 10])
+
+
+def flaky(point, x0):
+    if point == 30:
+        raise RuntimeError("rate limited")
+    if point == 50:
+        return scipy.optimize.OptimizeResult(x=np.ones(2), fun=1e20, success=True)
+    if point == 70:
+        return scipy.optimize.OptimizeResult(
+            x=np.ones(2), fun=1.0, success=False, message="no convergence"
+        )
+    return solve(point, x0)
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_run_sweep(tmp_path, workers):
+    with pytest.warns(UserWarning) as record:
+        done = run_sweep(
+            [1, 10, 30, 50, 70], tmp_path, flaky, workers=workers, seed=None
+        )
+    assert sorted(done) == [1, 10]
+    assert len(record) == 3
+    assert any("rate limited" in str(w.message) for w in record)
+    calls = []
+
+    def resumed(point, x0):
+        calls.append(point)
+        return solve(point, x0)
+
+    done = run_sweep([1, 10, 30, 50, 70, 100], tmp_path, resumed)
+    assert calls == [30, 50, 70, 100]
+    # seeded from the nearest solved point, with budgets scaled
+    assert np.array_equal(done[30].x, [30, 30])
+    assert np.array_equal(done[100].x, [100, 100])
+    assert scaled_neighbour(20, {1: done[1], 30: done[30]}) == pytest.approx([20, 20])
+
+
+def profiled(point, x0):
+    return solve(point * get_default_profile().per_kw().max(), x0)
+
+
+def test_run_sweep_default_profile(tmp_path, offline, monkeypatch):
+    # spawned workers start from a fresh import, without the profile set here
+    monkeypatch.setenv("CYDROGEN_OFFLINE", "1")
+    monkeypatch.setattr(
+        concurrent.futures,
+        "ProcessPoolExecutor",
+        functools.partial(
+            concurrent.futures.ProcessPoolExecutor,
+            mp_context=multiprocessing.get_context("spawn"),
+        ),
+    )
+    done = run_sweep([1, 10], tmp_path, profiled, workers=2, seed=None)
+    peak = offline.per_kw().max()
+    assert done[1].fun == peak and done[10].fun == 10 * peak
@@ -1,12 +1,17 @@
 import numpy as np
 import pytest
+import cydrogen
 from cydrogen import (
     BatteryConnectionToElectrolyserCompressorProcess,
     ElectrolyserCompressorProcess,
     EnergyStore,
+    H2Refueler,
     add_energy_sinks,
 )
-from cydrogen import EnergySystem
+from cydrogen import EnergySystem, Graph, HOUR, HOURS_PER_YEAR
+from cydrogen.graph import Edge, Node
+from cydrogen import SystemTemplate, basic_system
+from cydrogen import Aggregates, FinalState, Trajectory
 
 # each case if ordered with (A, U, P, dt)
 test_cases = [
@@ -150,6 +155,36 @@ def test_dU(A, U, P, dt):
     assert np.allclose(du_vectorized, du_naive)
 
 
+@pytest.mark.parametrize("A, U, P, dt", test_cases)
+def test_dU_sparse(A, U, P, dt):
+    src, dst = np.nonzero(A)
+    du_sparse = EnergySystem._dU_sparse(src, dst, A[src, dst], U, P[src, dst], dt)
+    assert np.allclose(du_sparse, EnergySystem._dU(A, U, P, dt))
+
+
+def test_sparse_kernel():
+    rng = np.random.default_rng(0)
+    n, scenarios = 100, 3
+    A = (rng.random((scenarios, n, n)) < 0.02) * rng.random((scenarios, n, n)) / 2
+    arrays = dict(
+        g=Graph.from_adjacency_matrix(A[0]),
+        U_0=rng.random((scenarios, n)),
+        U_max=np.full((scenarios, n), 2.0),
+        U_frac_dt_loss=np.zeros(n),
+        weighted_A=A,
+        process_power_limits=rng.random((scenarios, n, n)) / HOUR,
+        input_nodes=(),
+        inputs=np.zeros((HOURS_PER_YEAR, scenarios, 0)),
+    )
+    sparse = EnergySystem.from_arrays(**arrays)
+    dense = EnergySystem.from_arrays(**arrays, kernel="dense")
+    assert sparse.kernel == "sparse"
+    u = arrays["U_0"]
+    for _ in range(10):
+        assert np.allclose(sparse.update_state(u), dense.update_state(u))
+        u = dense.update_state(u)
+
+
 def test_tiny_system():
     in_ = EnergyStore(value=1, name="INPUT")
     out = EnergyStore(value=0, name="OUTPUT")
@@ -174,3 +209,249 @@ def test_purchasing():
     e = list(in_.edges_out)[0]
     assert e.purchased == 3701
     assert 1 < e.max_power_transfer < 1e6
+
+
+def test_stack():
+    systems = []
+    for purchased in (2500, 3000, 1e20):
+        in_ = EnergyStore(value=1e6, name="INPUT")
+        out = EnergyStore(value=0, name="OUTPUT")
+        in_.link_to(out, using=ElectrolyserCompressorProcess, purchased=purchased)
+        systems.append(EnergySystem(add_energy_sinks(in_.to_graph())))
+    batch = EnergySystem.stack(systems)
+    assert batch.U_max.shape == (3, 3)
+    assert batch.weighted_A.shape == batch.process_power_limits.shape == (3, 3, 3)
+    us = batch.simulate()
+    assert us.shape == (HOURS_PER_YEAR, 3, 3)
+    for k, s in enumerate(systems):
+        s.simulate()
+        assert batch.total_useful[k] == pytest.approx(s.total_useful)
+        assert batch.total_lost[k] == pytest.approx(s.total_lost)
+
+
+def test_recorders(tmp_path):
+    in_ = EnergyStore(value=1, name="INPUT")
+    out = EnergyStore(value=0, name="OUTPUT")
+    in_.link_to(out, using=ElectrolyserCompressorProcess, purchased=3000)
+    s = EnergySystem(add_energy_sinks(in_.to_graph()))
+    us = s.simulate()
+    assert s.final is not None and np.array_equal(s.final, us[-1])
+    final = s.simulate(FinalState())
+    assert np.array_equal(final, us[-1])
+    assert not hasattr(s, "us")
+    assert s.total_useful == us[-1, s.g.inspect_ordering().index("OUTPUT")]
+    out = s.simulate(Trajectory(nodes=["OUTPUT"], dtype=np.float32))
+    assert out.shape == (HOURS_PER_YEAR, 1) and out.dtype == np.float32
+    assert np.allclose(out[:, 0], us[:, s.g.inspect_ordering().index("OUTPUT")])
+    s.simulate(Trajectory(path=tmp_path / "us.npy"))
+    assert np.array_equal(np.load(tmp_path / "us.npy"), us)
+    agg = s.simulate(Aggregates())
+    assert np.allclose(agg.sum, us.sum(axis=0))
+    assert np.array_equal(agg.min, us.min(axis=0))
+    assert np.array_equal(agg.max, us.max(axis=0))
+    with pytest.raises(ValueError):
+        s.simulate(FinalState(), steps=0)
+
+
+def test_reaches():
+    systems = []
+    for purchased in (2500, 3000, 1e20):
+        in_ = EnergyStore(value=1e6, name="INPUT")
+        out = EnergyStore(value=0, name="OUTPUT")
+        in_.link_to(out, using=ElectrolyserCompressorProcess, purchased=purchased)
+        systems.append(EnergySystem(add_energy_sinks(in_.to_graph())))
+    for s in systems + [EnergySystem.stack(systems)]:
+        s.simulate(FinalState())
+        final = s.total_useful
+        for target in (0, 1e3, 1e5, 5e5, 1e6):
+            assert np.array_equal(s.reaches(target), final > target)
+        assert np.array_equal(s.reaches(final), np.zeros_like(final, dtype=bool))
+
+
+def test_reaches_inputs_and_negative_flows():
+    nodes = [Node(name=name) for name in ("PV", "OUTPUT", "STORE")]
+    g = Graph(nodes, [Edge(nodes[0], nodes[1]), Edge(nodes[2], nodes[1])])
+    A = np.array([[0, 1, 0], [0, 0, 0], [0, 1, 0]], dtype=np.float64)
+    s = EnergySystem.from_arrays(
+        g,
+        U_0=np.array([0, 0, 100.0]),
+        U_max=np.full(3, 1e9),
+        U_frac_dt_loss=np.zeros(3),
+        weighted_A=A,
+        process_power_limits=np.where(A != 0, 1e9, 0),
+        input_nodes=(0,),
+        inputs=np.zeros((HOURS_PER_YEAR, 1)),
+    )
+    ones = np.ones((HOURS_PER_YEAR, 1))
+    assert not s.reaches(1000, node="OUTPUT")
+    assert s.reaches(1000, node="OUTPUT", inputs=ones)
+    # a negative power limit, as bought below the installation cost, drains OUTPUT
+    s.process_power_limits[0, 1] = -1 / HOUR
+    s.set_kernel()
+    final = s.simulate(FinalState())[1]
+    assert final < 50
+    assert s.reaches(50, node="OUTPUT") == (final > 50)
+
+
+def test_sensitivity():
+    def system(process_spend, store_spend):
+        in_ = EnergyStore(value=1e8, name="INPUT")
+        out = H2Refueler(name="OUTPUT", purchased=store_spend)
+        e = in_.link_to(
+            out, using=ElectrolyserCompressorProcess, purchased=process_spend
+        )
+        s = EnergySystem(add_energy_sinks(in_.to_graph()))
+        s.spend_groups = [[e], [out]]
+        return s
+
+    for x in ([2300, 1e5], [3000, 1e5], [3000, 1600]):
+        s = system(*x)
+        d = s.sensitivity(steps=100)
+        j = s.g.inspect_ordering().index("OUTPUT")
+        assert np.array_equal(s.final, s.simulate(FinalState(), steps=100))
+        for k in range(2):
+            h = np.eye(2)[k] * x[k] * 1e-6
+            up, down = system(*(x + h)), system(*(x - h))
+            up.simulate(FinalState(), steps=100)
+            down.simulate(FinalState(), steps=100)
+            fd = (up.total_useful - down.total_useful) / (2 * h[k])
+            assert d[j, k] == pytest.approx(fd, rel=1e-5, abs=1e-9)
+
+
+def test_template(cloudy):
+    template = SystemTemplate.basic()
+    X = np.random.default_rng(1).uniform(4e3, 4e5, (5, 4))
+    batch = template(X)
+    batch.simulate(FinalState())
+    for k, x in enumerate(X):
+        s = basic_system(*x)
+        s.simulate(FinalState())
+        t = template(x)
+        t.simulate(FinalState())
+        assert np.array_equal(t.final, s.final)
+        assert np.array_equal(batch.final[k], s.final)
+    assert not template.valid([1000, 1e5, 1e5, 1e5])
+    with pytest.raises(ValueError, match="PV capacity"):
+        template(np.array([[1000, 1e5, 1e5, 1e5], X[0]]))
+
+
+def test_fast_forward(cloudy, monkeypatch):
+    # including budgets whose stores fill up or run empty during the night
+    X = np.array([[2.5e5] * 4, [5e5, 1e6, 1e4, 1e4], [1e5, 3e3, 5e4, 2e5]])
+    batch = SystemTemplate.basic()(X)
+    expected = batch.simulate().copy()
+    assert np.allclose(batch.simulate(fast_forward=True), expected, rtol=1e-12)
+
+    s = basic_system(*X[1])
+    expected = s.simulate().copy()
+    steps = 0
+    update_state = EnergySystem.update_state
+
+    def counted(self, U):
+        nonlocal steps
+        steps += 1
+        return update_state(self, U)
+
+    monkeypatch.setattr(EnergySystem, "update_state", counted)
+    assert np.allclose(s.simulate(fast_forward=True), expected, rtol=1e-12)
+    assert steps < 0.75 * HOURS_PER_YEAR
+
+
+def test_adaptive_steps(cloudy, monkeypatch):
+    X = np.array([[2.5e5] * 4, [5e5, 1e6, 1e4, 1e4], [1e5, 3e3, 5e4, 2e5]])
+    batch = SystemTemplate.basic()(X)
+    expected = batch.simulate().copy()
+    adaptive = batch.simulate(rtol=0.01)
+    within = np.abs(adaptive - expected).sum(axis=-1) <= 0.01 * batch.total_input
+    assert within.all()
+
+    s = basic_system(*X[1])
+    expected = s.simulate().copy()
+    minutes = s.with_timestep(cydrogen.MINUTE)
+    fine = minutes.simulate(FinalState(), steps=3 * 24 * 60).copy()
+    steps = 0
+    update_state = EnergySystem.update_state
+
+    def counted(self, U):
+        nonlocal steps
+        steps += 1
+        return update_state(self, U)
+
+    monkeypatch.setattr(EnergySystem, "update_state", counted)
+    s.simulate(fast_forward=True)
+    fast_forward, steps = steps, 0
+    us = s.simulate(rtol=0.1)
+    # coarser than fixed hourly steps, or only skipping the nights
+    assert steps < 0.75 * fast_forward < 0.5 * HOURS_PER_YEAR
+    assert (np.abs(us - expected).sum(axis=-1) <= 0.1 * s.total_input).all()
+    # hourly PV at minute steps is flat within each hour
+    steps = 0
+    assert np.allclose(
+        minutes.simulate(FinalState(), steps=3 * 24 * 60, rtol=1e-6), fine, rtol=1e-9
+    )
+    assert steps < 3 * 24 * 60 / 20
+
+
+def test_timestep(offline):
+    inputs = np.random.default_rng(0).uniform(0, 1, (48, 2))
+    fine = cydrogen.resample_inputs(inputs, HOUR, 15 * cydrogen.MINUTE)
+    assert fine.shape == (192, 2)
+    assert np.allclose(fine.sum(axis=0), inputs.sum(axis=0))
+    assert np.allclose(
+        cydrogen.resample_inputs(fine, 15 * cydrogen.MINUTE, HOUR), inputs
+    )
+
+    s = basic_system(*[1e5] * 4)
+    hourly = s.simulate(steps=72).copy()
+    assert np.array_equal(s.with_timestep(HOUR).simulate(steps=72), hourly)
+    assert np.allclose(
+        s.simulate(
+            steps=72,
+            inputs=cydrogen.resample_inputs(s.inputs[:72], HOUR, cydrogen.MINUTE),
+            inputs_dt=cydrogen.MINUTE,
+        ),
+        hourly,
+        rtol=1e-9,
+    )
+    # sub-hourly steps converge, and coarse steps stay non-negative
+    j = s.g.inspect_ordering().index("OUTPUT")
+    fine = s.with_timestep(cydrogen.MINUTE)
+    assert fine.inputs.shape == (60 * HOURS_PER_YEAR, 1)
+    reference = fine.simulate(FinalState(), steps=3 * 24 * 60)
+    half = s.with_timestep(HOUR / 2).simulate(FinalState(), steps=144)
+    assert np.allclose(half[j], reference[j], rtol=2e-2)
+    assert (s.with_timestep(6 * HOUR).simulate(steps=12) >= 0).all()
+
+
+def test_timestep_year(offline):
+    s = basic_system(*[1e5] * 4)
+    s.simulate(FinalState())
+    # a year by default, whatever the step
+    quarter = s.with_timestep(15 * cydrogen.MINUTE)
+    quarter.simulate(FinalState())
+    assert quarter.steps == 4 * HOURS_PER_YEAR
+    assert quarter.total_input == pytest.approx(s.total_input, rel=1e-12)
+    assert quarter.total_useful == pytest.approx(s.total_useful, rel=1e-3)
+    coarse = s.with_timestep(6 * HOUR)
+    coarse.simulate(FinalState())
+    assert coarse.steps == HOURS_PER_YEAR // 6
+    assert coarse.reaches(0.5 * coarse.total_useful)
+
+
+def test_timestep_losses(offline):
+    s = basic_system(*[1e5] * 4)
+    # hourly, as before timesteps were configurable: the loss per step is the loss rate times an hour
+    loss = HOUR * s.g.compile().node_column("static_frac_power_loss")
+    assert np.array_equal(s.U_frac_dt_loss, loss)
+    assert np.array_equal(
+        EnergySystem(s.g, dt=HOUR).simulate(steps=48), s.simulate(steps=48)
+    )
+    # other steps compound it, so that a store left alone loses the same per hour
+    half = EnergySystem(s.g, dt=HOUR / 2)
+    assert np.allclose(1 - (1 - half.U_frac_dt_loss) ** 2, loss, rtol=1e-12)
+    # rather than halving it, as scaling the loss rate by the step would
+    assert (half.U_frac_dt_loss[loss > 0] > loss[loss > 0] / 2).all()
+    u = np.full(loss.shape, 1e6)
+    for _ in range(2):
+        u = u * (1 - half.U_frac_dt_loss)
+    assert np.allclose(u, 1e6 * (1 - loss), rtol=1e-12)
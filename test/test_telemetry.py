@@ -0,0 +1,46 @@
+import json
+import numpy as np
+from cydrogen import JSONLines, RingBuffer, Telemetry, get_telemetry
+from cydrogen.cache import EvaluationCache
+from cydrogen.optimise import BudgetAllocator
+
+
+def test_disabled_by_default():
+    t = get_telemetry()
+    assert not t.enabled
+    with t.span("anything"):
+        t.count("anything")
+    assert not t.counters
+
+
+def test_optimiser_events(tmp_path, offline):
+    opt = BudgetAllocator({}, cache=EvaluationCache())
+    opt.total_budget = 1e6
+    opt.template()  # compiled once, before the run
+    buffer = RingBuffer()
+    with Telemetry(buffer, JSONLines(tmp_path / "run.jsonl")) as t:
+        opt.evaluate(np.array([0.25, 0.25, 0.25]))
+        opt.evaluate(np.array([0.25, 0.25, 0.25]))
+        opt.evaluate(np.array([0.6, 0.3, 0.3]))  # over budget
+        opt.evaluate(np.array([0, 0.3, 0.3]))  # no PV
+    t.close()
+    assert get_telemetry() is not t
+    summary = t.summary()
+    assert summary["counters"] == {
+        "cache_miss": 3,
+        "cache_hit": 1,
+        "penalty": 2,
+        "failure": 1,
+    }
+    spans = summary["spans"]
+    assert spans["evaluation"]["count"] == 4
+    # one build per evaluation that was not a cache hit, except the one over budget;
+    # the last fails in the PV fetch
+    assert spans["build"]["count"] == summary["counters"]["cache_miss"] - 1 == 2
+    assert spans["pv_fetch"]["count"] == 1
+    assert spans["time_loop"]["count"] == 1
+    assert spans["build"]["total"] >= spans["pv_fetch"]["total"]
+    events = [json.loads(line) for line in open(tmp_path / "run.jsonl")]
+    assert events == [{**e} for e in buffer.events]
+    assert any("Traceback" in e.get("traceback", "") for e in events)
+    assert "time_loop" in t.report()